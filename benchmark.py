@@ -0,0 +1,177 @@
+import json
+import time
+import tracemalloc
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from sys import argv
+
+import main
+from simulator import SimulatedFarm
+
+
+#######################################################################################
+# ------------------------------ benchmark part --------------------------------------#
+#######################################################################################
+
+# python benchmark.py [sizes=100,1000,10000] [scale=0.01] [main.py arguments: cfg maxth=N batch ...]
+#
+# the whole pipeline runs against simulated ASR901 (simulator.py), scale multiplies
+# all simulated durations (login, latency, squeeze, copy, verify /md5)
+#
+# python benchmark.py memory [sizes=10000,100000]
+#
+# memory of discovered devices kept for the whole run: CellSiteGateway against the dict-backed
+# class with stored short names (LegacyCellSiteGateway)
+
+
+def get_bench_argv(arguments):
+    sizes = [100, 1000, 10000]
+    farm_settings = {"scale": 0.01}
+    main_arguments = []
+    for arg in arguments[1:]:
+        if arg == "memory":
+            farm_settings["memory"] = True
+        elif arg.startswith("sizes="):
+            sizes = [int(i) for i in arg.split("=")[1].split(",")]
+        elif arg.startswith("scale="):
+            farm_settings["scale"] = float(arg.split("=")[1])
+        elif arg.split("=")[0] in ("login_fail", "auth_fail", "refused", "md5_fail", "copy_stall"):
+            farm_settings[arg.split("=")[0]] = float(arg.split("=")[1])
+        else:
+            main_arguments.append(arg)
+    return sizes, farm_settings, main_arguments
+
+
+def bench(size, farm_settings, main_arguments):
+    farm = SimulatedFarm(**farm_settings)
+    inventory = farm.generate(size)
+    # copy output is polled, poll as often as the simulated copy is shorter
+    main.COPY_POLL_INTERVAL = min(1, farm.copy_time * farm.scale / 10)
+
+    with tempfile.TemporaryDirectory() as tmp, redirect_stdout(StringIO()):
+        log_folder = Path(tmp)
+        settings = main.get_argv(main_arguments)
+        settings["state"] = str(log_folder / "state.db")
+        settings["connect_handler"] = farm.ConnectHandler
+        main.prepare(settings, log_folder)
+        devs = [main.CellSiteGateway(ip=ip, host=hostname) for hostname, ip in inventory.items()]
+
+        tracemalloc.start()
+        start = time.monotonic()
+        main.run("user", "password", devs, settings, log_folder, "bench")
+        wall = time.monotonic() - start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if settings["progress"]:
+            settings["progress"].close()
+        failed_connection, errors = settings["logwriter"].close()
+        summary = settings["metrics"].summary()
+        settings["store"].close()
+
+    return {"devices": size,
+            "wall": wall,
+            "memory": memory,
+            "peak_sessions": farm.peak_sessions,
+            "logins": farm.logins,
+            "failed_connection": failed_connection,
+            "errors": errors,
+            "devices_per_hour": summary["devices_per_hour"]}
+
+
+class LegacyCellSiteGateway:
+    # CellSiteGateway before __slots__: attributes in __dict__, short names stored next to full names
+
+    def __init__(self, ip, host):
+        dev = main.CellSiteGateway(ip=ip, host=host)
+        for field in main.CellSiteGateway.__slots__:
+            setattr(self, field, getattr(dev, field))
+        self.ios_list_short = []
+        self.current_ios_short = None
+        self.ios_copied_short = None
+        self.boot_short = None
+        self.ios_to_delete_short = []
+        self.current_boot_short = None
+
+
+def legacy_from_dict(data):
+    dev = LegacyCellSiteGateway(ip=data["ip_address"], host=data["hostname"])
+    for field in main.PLAN_FIELDS:
+        setattr(dev, field, data[field])
+    dev.current_ios_short = main.ios_short(dev.current_ios)
+    dev.ios_copied_short = main.ios_short(dev.ios_copied)
+    dev.boot_short = main.ios_short(dev.boot)
+    dev.current_boot_short = main.ios_short(dev.current_boot)
+    dev.ios_to_delete_short = [short for short in map(main.ios_short, dev.ios_to_delete) if short]
+    dev.ios_list_short = [short for short in map(main.ios_short, dev.ios_list) if short]
+    return dev
+
+
+def discovered_records(size):
+    # discovery of simulated devices, saved as json like plan file or worker records
+    farm = SimulatedFarm(scale=0)
+    settings = {"batch": True, "squeeze": False, "image_policy": main.compile_policy(main.DEFAULT_POLICY)}
+    records = []
+    for hostname, ip in farm.generate(size).items():
+        dev = main.CellSiteGateway(ip=ip, host=hostname)
+        connection = farm.ConnectHandler(ip=ip)
+        main.discovery_steps(dev, connection, settings)
+        connection.disconnect()
+        records.append(json.dumps(main.dev_to_dict(dev)))
+    return records
+
+
+def bench_memory(size):
+    records = discovered_records(size)
+    result = {"devices": size}
+    for name, from_dict in (("legacy", legacy_from_dict), ("compact", main.dev_from_dict)):
+        tracemalloc.start()
+        devs = [from_dict(json.loads(record)) for record in records]
+        result[name] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del devs
+    return result
+
+
+def print_memory_results(results):
+    print()
+    print("-------------------------------------------------------------------------------------------------------")
+    print("devices    legacy MB    compact MB    legacy bytes/device    compact bytes/device    saved")
+    print("-------------------------------------------------------------------------------------------------------")
+    for result in results:
+        print(f"{result['devices']:<11}{result['legacy'] / 1024 / 1024:<13.1f}{result['compact'] / 1024 / 1024:<14.1f}"
+              f"{result['legacy'] // result['devices']:<23}{result['compact'] // result['devices']:<24}"
+              f"{1 - result['compact'] / result['legacy']:.0%}")
+    print("-------------------------------------------------------------------------------------------------------")
+    print("memory of discovered devices (tracemalloc), loaded from json records like plan= or worker records\n")
+
+
+def print_results(results, farm_settings, main_arguments):
+    print()
+    print(f"simulated durations scale: {farm_settings['scale']}  arguments: {' '.join(main_arguments)}")
+    print("-------------------------------------------------------------------------------------------------------")
+    print("devices    wall time    peak memory    peak sessions    logins    failed/errors    devices/hour")
+    print("-------------------------------------------------------------------------------------------------------")
+    for result in results:
+        print(f"{result['devices']:<11}{result['wall']:<13.1f}{result['memory'] / 1024 / 1024:<15.1f}"
+              f"{result['peak_sessions']:<17}{result['logins']:<10}"
+              f"{result['failed_connection']}/{result['errors']:<15}{result['devices_per_hour']}")
+    print("-------------------------------------------------------------------------------------------------------")
+    print("wall time in seconds, peak memory in MB (tracemalloc)\n")
+
+
+if __name__ == "__main__":
+    bench_sizes, bench_farm_settings, bench_main_arguments = get_bench_argv(argv)
+    bench_results = []
+    if bench_farm_settings.pop("memory", False):
+        for bench_size in bench_sizes:
+            bench_results.append(bench_memory(bench_size))
+            print(f"{bench_size} devices: done")
+        print_memory_results(bench_results)
+    else:
+        for bench_size in bench_sizes:
+            bench_results.append(bench(bench_size, bench_farm_settings, bench_main_arguments))
+            print(f"{bench_size} devices: {bench_results[-1]['wall']:.1f}s")
+        print_results(bench_results, bench_farm_settings, bench_main_arguments)
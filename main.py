@@ -3,12 +3,24 @@ import time
 import os
 import queue
 import re
+import json
+import random
+import sqlite3
+import shlex
+import subprocess
+import socket
+import sys
+import ipaddress
 from pathlib import Path
 from pprint import pformat
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from contextlib import redirect_stdout
 from sys import argv
-from datetime import datetime
+from datetime import datetime, timedelta
 from netmiko import ConnectHandler
+from netmiko.exceptions import NetmikoAuthenticationException, NetmikoTimeoutException
+from transport import RecordingConnection, ReplayConnection, ReplayHandler, AsyncTransport, load_corpus
+from simulator import SimulatedFarm
 
 
 #######################################################################################
@@ -16,6 +28,17 @@ from netmiko import ConnectHandler
 #######################################################################################
 
 class CellSiteGateway:
+    # slots instead of __dict__, image names are interned (see dir_ios_parse, dev_from_dict),
+    # short names (156-2.SP9) are computed from full names when needed
+
+    __slots__ = ("hostname", "ip_address", "os_type", "connection_status", "connection_error_msg",
+                 "connection_error_type", "ios_list", "logging", "sfp_vendor_cisco", "sfp_vendor", "error",
+                 "error_msg", "policy_group", "current_ios", "md5_correct", "md5", "ios_copied", "boot",
+                 "ios_to_delete", "delete_files", "squeeze_result", "current_boot", "check_squeeze", "discovered",
+                 "last_step", "flash_sizes", "flash_total", "flash_free", "flash_deleted", "squeeze_needed",
+                 "squeeze_reason", "squeeze_saved", "pagg", "copy_source", "discovery_commands",
+                 "discovery_commands_legacy", "discovery_time", "delete_result", "timings", "commands", "copy_rate",
+                 "deferred", "requeue", "copy_slot", "md5_cache")
 
     def __init__(self, ip, host):
         self.hostname = host
@@ -24,30 +47,698 @@ class CellSiteGateway:
 
         self.connection_status = True  # failed connection status, False if connection fails
         self.connection_error_msg = ""  # connection error message
+        self.connection_error_type = ""  # timeout, auth, refused, other
 
         self.ios_list = []
-        self.ios_list_short = []
         self.logging = []
         self.sfp_vendor_cisco = []  # True False
         self.sfp_vendor = []
         self.error = False
         self.error_msg = []
-        self.pagg_xe = None
+        self.policy_group = None  # image policy group of the pagg, see compile_policy
         self.current_ios = None
-        self.current_ios_short = None
         self.md5_correct = None
         self.md5 = None
         self.ios_copied = ""
-        self.ios_copied_short = None
         self.boot = ""
-        self.boot_short = None
         self.ios_to_delete = []
-        self.ios_to_delete_short = []
         self.delete_files = []
         self.squeeze_result = None
         self.current_boot = ""
-        self.current_boot_short = None
         self.check_squeeze = False
+        self.discovered = False  # True when discovery part is done (or loaded from plan)
+        self.last_step = None  # last completed pipeline step, see STEPS
+        self.flash_sizes = {}  # file name: size in bytes from dir flash:
+        self.flash_total = 0
+        self.flash_free = 0
+        self.flash_deleted = 0  # bytes of deleted files (dir /a), reclaimed only by squeeze
+        self.squeeze_needed = False
+        self.squeeze_reason = ""
+        self.squeeze_saved = 0  # predicted seconds saved by skipped squeeze
+        self.pagg = None  # pagg hostname from sh isis hostname
+        self.copy_source = ""
+        self.discovery_commands = 0  # round trips of discovery
+        self.discovery_commands_legacy = 0  # round trips of discovery without batch
+        self.discovery_time = 0
+        self.delete_result = {}  # file name: True if deleted
+        self.timings = {}  # step: seconds, plus login and total
+        self.commands = []  # [command, seconds] of every command sent
+        self.copy_rate = None  # bytes/sec of the last copy
+        self.deferred = ""  # why the device is left for resume: circuit breaker, maintenance window
+        self.requeue = False  # no free copy source, session is closed and device goes to the end of the queue
+        self.copy_slot = ""  # copy source taken before login, see connect_one
+        self.md5_cache = ""  # hit or miss of md5 cache in this run, sent to the coordinator with the record
+
+    @property
+    def current_ios_short(self):
+        return ios_short(self.current_ios)
+
+    @property
+    def ios_copied_short(self):
+        return ios_short(self.ios_copied)
+
+    @property
+    def boot_short(self):
+        return ios_short(self.boot)
+
+    @property
+    def current_boot_short(self):
+        return ios_short(self.current_boot)
+
+    @property
+    def ios_to_delete_short(self):
+        return [short for short in map(ios_short, self.ios_to_delete) if short]
+
+    @property
+    def ios_list_short(self):
+        return [short for short in map(ios_short, self.ios_list) if short]
+
+
+class TokenBucket:
+    # rate logins per second, up to burst logins at once
+
+    def __init__(self, rate, burst):
+        self.lock = Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class LoginLimiter:
+    # global and per region (hostname prefix: alma, asta, ...) login rate, 0 - no limit
+
+    def __init__(self, rate, region_rate):
+        self.lock = Lock()
+        self.region_rate = region_rate
+        self.bucket = TokenBucket(rate, max(rate, 1)) if rate else None
+        self.regions = {}
+
+    def acquire(self, dev):
+        if self.region_rate:
+            region = dev.hostname.split("-")[0]
+            with self.lock:
+                if region not in self.regions:
+                    self.regions[region] = TokenBucket(self.region_rate, max(self.region_rate, 1))
+            self.regions[region].acquire()
+        if self.bucket:
+            self.bucket.acquire()
+
+
+class Distributor:
+    # chooses the source of the image for every copy:
+    # first seeds_per_pagg devices behind a PAGG copy from origin/mirrors (seeds),
+    # the others copy from mirrors or from verified seeds behind the same PAGG (peers)
+
+    def __init__(self, origin, mirrors, source_limit, seeds_per_pagg, use_peers, pagg_limit=0):
+        self.cond = Condition()
+        self.upstream = [origin] + mirrors
+        self.mirrors = mirrors
+        self.source_limit = source_limit  # max copies in progress per source, 0 - no limit
+        self.seeds_per_pagg = seeds_per_pagg
+        self.use_peers = use_peers
+        self.pagg_limit = pagg_limit  # max copies in progress behind one PAGG, 0 - no limit
+        self.active = {}  # source: copies in progress
+        self.pagg_active = {}  # pagg: copies in progress
+        self.seeds = {}  # (pagg, image): hostnames of seeds
+        self.seeds_pending = {}  # (pagg, image): hostnames of seeds which are not verified yet
+        self.peers = {}  # (pagg, image): sources served by verified seeds
+        self.sharing = []  # seeds with tftp-server, it is removed at the end of the run
+
+    def candidates(self, dev, key, exclude):
+        if not self.use_peers or dev.pagg is None:
+            sources = self.upstream
+        else:
+            seeds = self.seeds.setdefault(key, [])
+            if dev.hostname not in seeds and len(seeds) < self.seeds_per_pagg:
+                seeds.append(dev.hostname)
+                self.seeds_pending.setdefault(key, set()).add(dev.hostname)
+            if dev.hostname in seeds:
+                sources = self.upstream
+            else:
+                sources = self.peers.get(key, []) + self.mirrors
+                if not sources and not self.seeds_pending.get(key):
+                    # no mirrors and all seeds failed
+                    sources = self.upstream
+        return [src for src in sources if src not in exclude]
+
+    def free_sources(self, dev, exclude):
+        key = (dev.pagg, dev.ios_copied)
+        sources = self.candidates(dev, key, exclude)
+        if not sources and exclude:
+            sources = self.candidates(dev, key, ())
+        if self.pagg_limit and self.pagg_active.get(dev.pagg, 0) >= self.pagg_limit:
+            return []
+        return [src for src in sources if not self.source_limit or self.active.get(src, 0) < self.source_limit]
+
+    def try_acquire(self, dev, exclude=()):
+        # source with the least copies in progress, None if all sources or the pagg are busy
+        with self.cond:
+            free = self.free_sources(dev, exclude)
+            if not free:
+                return None
+            src = min(free, key=lambda x: self.active.get(x, 0))
+            self.active[src] = self.active.get(src, 0) + 1
+            self.pagg_active[dev.pagg] = self.pagg_active.get(dev.pagg, 0) + 1
+            return src
+
+    def wait(self, timeout):
+        # until some copy is finished or a seed is verified
+        with self.cond:
+            self.cond.wait(timeout)
+
+    def release(self, dev, src):
+        with self.cond:
+            self.active[src] -= 1
+            self.pagg_active[dev.pagg] -= 1
+            self.cond.notify_all()
+
+    def is_seed(self, dev):
+        return dev.hostname in self.seeds_pending.get((dev.pagg, dev.ios_copied), ())
+
+    def seed_done(self, dev, peer_source=None):
+        key = (dev.pagg, dev.ios_copied)
+        with self.cond:
+            self.seeds_pending.get(key, set()).discard(dev.hostname)
+            if peer_source:
+                self.peers.setdefault(key, []).append(peer_source)
+                self.sharing.append(dev)
+            self.cond.notify_all()
+
+
+class TimedConnection:
+    # wraps netmiko connection, every command is timed into dev.commands
+
+    def __init__(self, connection, dev):
+        self.connection = connection
+        self.dev = dev
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def timed(self, name, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.dev.commands.append([name, round(time.monotonic() - start, 3)])
+
+    def send_command(self, command_string, *args, **kwargs):
+        return self.timed(command_string, self.connection.send_command, command_string, *args, **kwargs)
+
+    def send_config_set(self, config_commands, *args, **kwargs):
+        return self.timed("; ".join(config_commands), self.connection.send_config_set,
+                          config_commands, *args, **kwargs)
+
+    def save_config(self, *args, **kwargs):
+        return self.timed("save_config", self.connection.save_config, *args, **kwargs)
+
+    def read_until_pattern(self, *args, **kwargs):
+        return self.timed("batch", self.connection.read_until_pattern, *args, **kwargs)
+
+
+class SessionPool:
+    # warm ssh sessions of daemon mode, one per ip address, at most size sessions are open.
+    # idle session is checked (is_alive) before reuse and closed after idle seconds
+    # or when a session to another device needs its place
+
+    def __init__(self, size, idle):
+        self.cond = Condition()
+        self.size = size
+        self.idle = idle
+        self.idle_sessions = {}  # ip: (connection, released at)
+        self.busy = {}  # ip: connection, None while login is in progress
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def acquire(self, dev, login):
+        to_close = []
+        with self.cond:
+            connection = self.idle_sessions.pop(dev.ip_address, (None, None))[0]
+            if connection is None:
+                while len(self.busy) + len(self.idle_sessions) >= self.size:
+                    if self.idle_sessions:
+                        oldest = min(self.idle_sessions, key=lambda ip: self.idle_sessions[ip][1])
+                        to_close.append(self.idle_sessions.pop(oldest)[0])
+                        self.evicted += 1
+                    else:
+                        self.cond.wait()
+            self.busy[dev.ip_address] = None
+        for old_connection in to_close:
+            self.close(old_connection)
+
+        if connection is not None and not self.alive(connection):
+            self.close(connection)
+            connection = None
+        try:
+            if connection is None:
+                connection = login()
+                with self.cond:
+                    self.opened += 1
+            else:
+                with self.cond:
+                    self.reused += 1
+        except Exception:
+            with self.cond:
+                del self.busy[dev.ip_address]
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.busy[dev.ip_address] = connection
+        return connection
+
+    def release(self, dev, healthy=True):
+        with self.cond:
+            if dev.ip_address not in self.busy:
+                return
+            connection = self.busy.pop(dev.ip_address)
+            if healthy and connection is not None:
+                self.idle_sessions[dev.ip_address] = (connection, time.monotonic())
+            self.cond.notify()
+        if not healthy and connection is not None:
+            self.close(connection)
+
+    def evict(self):
+        # closes sessions idle longer than self.idle
+        now = time.monotonic()
+        with self.cond:
+            expired = [ip for ip, (_, released) in self.idle_sessions.items() if now - released >= self.idle]
+            to_close = [self.idle_sessions.pop(ip)[0] for ip in expired]
+            self.evicted += len(to_close)
+            self.cond.notify_all()
+        for connection in to_close:
+            self.close(connection)
+
+    def close_all(self):
+        with self.cond:
+            to_close = [connection for connection, _ in self.idle_sessions.values()]
+            self.idle_sessions = {}
+        for connection in to_close:
+            self.close(connection)
+
+    def stats(self):
+        with self.cond:
+            return {"idle": len(self.idle_sessions), "busy": len(self.busy),
+                    "opened": self.opened, "reused": self.reused, "evicted": self.evicted}
+
+    @staticmethod
+    def alive(connection):
+        try:
+            return connection.is_alive()
+        except Exception:
+            return False
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.disconnect()
+        except Exception:
+            pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Metrics:
+    # step durations of finished devices, summary is p50/p95/max per step and devices per hour
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.monotonic()
+        self.devices = 0
+        self.steps = {}  # step: list of seconds
+        self.copy_rates = []
+
+    def add(self, record):
+        with self.lock:
+            self.devices += 1
+            if record["copy_rate"] is not None:
+                self.copy_rates.append(record["copy_rate"])
+            for step, seconds in record["timings"].items():
+                self.steps.setdefault(step, []).append(seconds)
+            for command, seconds in record["commands"]:
+                self.steps.setdefault("send_command", []).append(seconds)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            steps = {step: {"count": len(values),
+                            "p50": round(percentile(values, 50), 3),
+                            "p95": round(percentile(values, 95), 3),
+                            "max": round(max(values), 3)}
+                     for step, values in self.steps.items()}
+            copy_rate = {}
+            if self.copy_rates:
+                copy_rate = {"count": len(self.copy_rates),
+                             "min": min(self.copy_rates),
+                             "p50": percentile(self.copy_rates, 50)}
+            return {"devices": self.devices,
+                    "elapsed": round(elapsed, 1),
+                    "devices_per_hour": round(self.devices * 3600 / elapsed, 1) if elapsed else 0,
+                    "steps": steps,
+                    "copy_rate": copy_rate}
+
+    def write(self, metrics_file, prom_file=None):
+        summary = self.summary()
+        with open(metrics_file, "w") as file:
+            json.dump(summary, file, indent=1)
+        if prom_file:
+            lines = ["# HELP asr901_upgrade_step_seconds duration of pipeline step",
+                     "# TYPE asr901_upgrade_step_seconds summary"]
+            for step, values in summary["steps"].items():
+                lines.append(f'asr901_upgrade_step_seconds{{step="{step}",quantile="0.5"}} {values["p50"]}')
+                lines.append(f'asr901_upgrade_step_seconds{{step="{step}",quantile="0.95"}} {values["p95"]}')
+                lines.append(f'asr901_upgrade_step_seconds_count{{step="{step}"}} {values["count"]}')
+            lines.append("# TYPE asr901_upgrade_step_seconds_max gauge")
+            for step, values in summary["steps"].items():
+                lines.append(f'asr901_upgrade_step_seconds_max{{step="{step}"}} {values["max"]}')
+            lines.append("# TYPE asr901_upgrade_devices gauge")
+            lines.append(f"asr901_upgrade_devices {summary['devices']}")
+            lines.append("# TYPE asr901_upgrade_devices_per_hour gauge")
+            lines.append(f"asr901_upgrade_devices_per_hour {summary['devices_per_hour']}")
+            # textfile collector must never see a half written file
+            tmp_file = f"{prom_file}.tmp"
+            with open(tmp_file, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            os.replace(tmp_file, prom_file)
+        return summary
+
+
+class CircuitBreaker:
+    # error rate of the current wave (dev.error, md5 is not correct, squeeze failed).
+    # the breaker opens when it is over max_rate, devices which are not started yet stay for resume
+
+    def __init__(self, max_rate, min_devices=5):
+        self.lock = Lock()
+        self.max_rate = max_rate
+        self.min_devices = min_devices  # before the end of a wave the rate is checked after min_devices
+        self.finished = 0
+        self.failed = 0
+        self.open = False
+        self.reason = ""
+
+    def new_wave(self):
+        with self.lock:
+            self.finished = 0
+            self.failed = 0
+
+    def add(self, record):
+        with self.lock:
+            self.finished += 1
+            if record["error"] or record["md5_correct"] is False or record["squeeze_result"] is False:
+                self.failed += 1
+            if self.finished >= self.min_devices:
+                self.check()
+
+    def end_wave(self):
+        with self.lock:
+            if self.finished:
+                self.check()
+            return not self.open
+
+    def check(self):
+        if not self.open and self.failed / self.finished > self.max_rate:
+            self.open = True
+            self.reason = f"{self.failed} of {self.finished} devices failed, max rate {self.max_rate}"
+
+
+class Progress:
+    # live status of the run, status file is rewritten every interval seconds:
+    # devices per stage, throughput, eta from step durations of finished devices, slowest devices in flight
+
+    def __init__(self, log_folder, settings):
+        self.lock = Lock()
+        self.interval = settings["status"]
+        shard = "" if settings["shard"] is None else f"_shard{settings['shard'][0]}"
+        log_folder.mkdir(parents=True, exist_ok=True)
+        self.status_file = log_folder / f"{settings['runtime']}_status{shard}.txt"
+        self.start = time.monotonic()
+        self.devices = {}  # hostname: [stage, stage started, device started]
+        self.concurrency = 1
+        self.finished = 0
+        self.failed_connection = 0
+        self.errors = 0
+        self.step_seconds = {}  # step: seconds of all finished devices
+        self.stopped = Event()
+        self.thread = Thread(target=self.refresh, daemon=True)
+        self.thread.start()
+
+    def add(self, devs):
+        # devices are added once, before the first of them starts (all waves, both phases),
+        # a device added again keeps its stage (planned after discovery)
+        now = time.monotonic()
+        with self.lock:
+            for dev in devs:
+                self.devices.setdefault(dev.hostname, ["queued", now, None])
+
+    def threads(self, concurrency):
+        with self.lock:
+            self.concurrency = concurrency
+
+    def stage(self, dev, stage):
+        now = time.monotonic()
+        with self.lock:
+            state = self.devices.get(dev.hostname)
+            if state is None:
+                return
+            state[0] = stage
+            state[1] = now
+            if state[2] is None:
+                state[2] = now
+
+    def done(self, record):
+        with self.lock:
+            self.devices.pop(record["hostname"], None)
+            self.finished += 1
+            self.failed_connection += not record["connection_status"]
+            self.errors += bool(record["error"])
+            for step, seconds in record["timings"].items():
+                self.step_seconds[step] = self.step_seconds.get(step, 0) + seconds
+
+    def eta(self, now):
+        # seconds of work left: average step durations for every device not finished yet,
+        # minus the time already spent in the current step, shared by the threads
+        if not self.finished:
+            return None
+        order = ("login",) + STEPS
+        means = {step: self.step_seconds.get(step, 0) / self.finished for step in order}
+        work = 0
+        for stage, stage_start, _ in self.devices.values():
+            if stage == "queued":
+                work += sum(means.values())
+            elif stage == "planned":
+                work += sum(means.values()) - means["discovery"]
+            else:
+                position = order.index(stage)
+                work += max(means[stage] - (now - stage_start), 0) + sum(means[i] for i in order[position + 1:])
+        return work / max(1, min(self.concurrency, len(self.devices)))
+
+    def status(self):
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.start
+            stages = {stage: 0 for stage in ("queued", "login") + STEPS + ("planned",)}
+            in_flight = []
+            for hostname, (stage, stage_start, device_start) in self.devices.items():
+                stages[stage] += 1
+                if stage not in ("queued", "planned"):
+                    in_flight.append((now - device_start, hostname, stage, now - stage_start))
+            eta = self.eta(now)
+            means = {step: seconds / self.finished for step, seconds in self.step_seconds.items()} if self.finished else {}
+            lines = [f"{datetime.now().strftime('%Y.%m.%d %H:%M:%S')}  elapsed: {int(elapsed)}s  "
+                     f"eta: {'unknown' if eta is None else f'{int(eta)}s'}",
+                     f"devices: {self.finished + len(self.devices)}  finished: {self.finished}  "
+                     f"in flight: {len(in_flight)}  queued: {stages['queued'] + stages['planned']}",
+                     f"failed connection: {self.failed_connection}  errors: {self.errors}  "
+                     f"throughput: {round(self.finished * 3600 / elapsed, 1) if elapsed else 0} devices/hour",
+                     "",
+                     "stage          devices   avg s"]
+        for stage, number in stages.items():
+            lines.append(f"{stage:15}{number:<10}{round(means[stage], 1) if stage in means else ''}")
+        lines += ["", "slowest in flight        stage          in stage s   total s"]
+        for device_time, hostname, stage, stage_time in sorted(in_flight, reverse=True)[:10]:
+            lines.append(f"{hostname:25}{stage:15}{int(stage_time):<13}{int(device_time)}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        tmp_file = self.status_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            file.write(self.status())
+        os.replace(tmp_file, self.status_file)
+
+    def refresh(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+class LogWriter:
+    # log files are written device by device, as soon as a device is finished
+
+    def __init__(self, log_folder, settings):
+        self.lock = Lock()
+        self.cfg = settings["cfg"]
+        self.failed_connection = 0
+        self.errors = 0
+        current_date = datetime.now().strftime("%Y.%m.%d")
+        current_time = settings["runtime"]
+        log_folder.mkdir(parents=True, exist_ok=True)
+
+        self.err_msg = log_folder / f"{current_time}_connection_error_msg.txt"
+        self.log = log_folder / f"{current_time}_logs.txt"
+        self.error = log_folder / f"{current_time}_error_logs.txt"
+        self.vendor = log_folder / f"{current_time}_sfp_vendor.txt"
+        self.results = log_folder / f"{current_time}_results.jsonl"
+
+        self.err_msg_file = open(self.err_msg, "w")
+        self.err_msg_file.write(f"{current_date} {current_time}\n\n")
+
+        self.log_file = open(self.log, "w")
+        self.log_file.write(f"{current_date} {current_time}\n\n")
+
+        self.error_file = open(self.error, "w")
+        self.error_file.write(f"{current_date} {current_time}\n\n")
+
+        self.vendor_file = open(self.vendor, "w")
+        self.vendor_file.write(f"{current_date} {current_time}\n\n")
+
+        self.results_file = open(self.results, "w")
+
+    def write(self, record):
+        with self.lock:
+            if not record["connection_status"]:
+                self.failed_connection += 1
+                self.err_msg_file.write("-" * 80 + "\n")
+                self.err_msg_file.write(f"{record['hostname']} : {record['ip_address']}\n\n")
+                self.err_msg_file.write(f"{record['connection_error_msg']}\n")
+                self.err_msg_file.flush()
+            else:
+                self.log_file.write("-" * 80 + "\n")
+                self.log_file.write(f"{record['hostname']} : {record['ip_address']}\n\n")
+                self.log_file.write(record["logging"])
+                self.log_file.write("\n\n")
+                self.log_file.flush()
+                self.vendor_file.write(f"{record['hostname']}: {record['sfp_vendor']}\n")
+                self.vendor_file.flush()
+            if record["error"]:
+                self.errors += 1
+                self.error_file.write("-" * 80 + "\n")
+                self.error_file.write(f"{record['hostname']} : {record['ip_address']}\n\n")
+                self.error_file.write(pformat(record["error_msg"]))
+                self.error_file.write("\n\n")
+                self.error_file.flush()
+            self.results_file.write(json.dumps(record) + "\n")
+            self.results_file.flush()
+
+    def close(self):
+        self.err_msg_file.close()
+        self.log_file.close()
+        self.error_file.close()
+        self.vendor_file.close()
+        self.results_file.close()
+
+        if not self.cfg:
+            self.log.unlink()
+
+        if self.failed_connection == 0:
+            self.err_msg.unlink()
+
+        if self.errors == 0:
+            self.error.unlink()
+
+        return self.failed_connection, self.errors
+
+
+class StateStore:
+    # per-device state keyed by hostname, saved after every pipeline step
+
+    def __init__(self, db_file):
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS devices ("
+                        "hostname TEXT PRIMARY KEY, ip_address TEXT, ios_list TEXT, current_ios TEXT, "
+                        "current_boot TEXT, sfp_vendor TEXT, md5_correct INTEGER, last_step TEXT, "
+                        "state TEXT, updated TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS md5_cache ("
+                        "hostname TEXT, filename TEXT, size INTEGER, md5 TEXT, verified TEXT, "
+                        "PRIMARY KEY (hostname, filename))")
+        self.db.commit()
+        self.md5_hits = 0
+        self.md5_misses = 0
+
+    def save(self, dev):
+        row = (dev.hostname, dev.ip_address, json.dumps(dev.ios_list), dev.current_ios, dev.current_boot,
+               json.dumps(dev.sfp_vendor), dev.md5_correct, dev.last_step, json.dumps(dev_to_dict(dev)),
+               datetime.now().isoformat(timespec="seconds"))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self.db.commit()
+
+    def load(self, hostname):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM devices WHERE hostname = ?", (hostname,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def reset(self, devs):
+        with self.lock:
+            self.db.executemany("DELETE FROM devices WHERE hostname = ?", [(dev.hostname,) for dev in devs])
+            self.db.commit()
+
+    def md5_cached(self, hostname, filename, size, md5):
+        with self.lock:
+            row = self.db.execute("SELECT size, md5 FROM md5_cache WHERE hostname = ? AND filename = ?",
+                                  (hostname, filename)).fetchone()
+            hit = row is not None and size is not None and row[0] == size and row[1] == md5
+            if hit:
+                self.md5_hits += 1
+            else:
+                self.md5_misses += 1
+        return hit
+
+    def md5_count(self, result):
+        # lookups made by workers are counted in the coordinator
+        with self.lock:
+            if result == "hit":
+                self.md5_hits += 1
+            elif result == "miss":
+                self.md5_misses += 1
+
+    def md5_save(self, hostname, filename, size, md5):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO md5_cache VALUES (?, ?, ?, ?, ?)",
+                            (hostname, filename, size, md5, datetime.now().isoformat(timespec="seconds")))
+            self.db.commit()
+
+    def md5_forget(self, hostname, filename):
+        with self.lock:
+            self.db.execute("DELETE FROM md5_cache WHERE hostname = ? AND filename = ?", (hostname, filename))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 
 #######################################################################################
@@ -55,23 +746,231 @@ class CellSiteGateway:
 #######################################################################################
 
 def get_argv(arguments):
-    settings = {"maxth": 20,
+    settings = {"maxth": 200,
+                "engine": "threads",
                 "cfg": False,
-                "force": False}
+                "force": False,
+                "twophase": False,
+                "discth": 200,
+                "plan": None,
+                "state": "logs/state.db",
+                "resume": False,
+                "reverify": False,
+                "squeeze": False,
+                "ftp": "ftp://212.19.149.62/",
+                "mirrors": [],
+                "srclimit": 0,
+                "peers": False,
+                "seeds": 2,
+                "pagglimit": 0,
+                "batch": False,
+                "prom": None,
+                "record": None,
+                "replay": None,
+                "replan": None,
+                "loginrate": 0,
+                "regionrate": 0,
+                "attempts": 2,
+                "backoff": 5,
+                "minrate": 0,
+                "stallwin": 120,
+                "bangbytes": 4096,
+                "copyretry": 1,
+                "workers": 0,
+                "hosts": [],
+                "remotedir": None,
+                "shard": None,
+                "worker": False,
+                "runtime": None,
+                "sim": 0,
+                "simscale": 0.01,
+                "include": None,
+                "exclude": None,
+                "region": [],
+                "iprange": [],
+                "failed": None,
+                "daemon": False,
+                "poolsize": 200,
+                "idle": 600,
+                "socket": "logs/daemon.sock",
+                "policy": DEFAULT_POLICY_FILE,
+                "status": 10,
+                "waves": None,
+                "wavesize": 10,
+                "maxerr": None,
+                "window": None,
+                "windowguard": 30}
     for arg in arguments:
         if arg == "cfg":
             settings["cfg"] = True
         elif arg == "force":
             settings["force"] = True
             settings["cfg"] = True
+        elif arg == "async":
+            settings["engine"] = "async"
+        elif arg.startswith("maxth="):
+            settings["maxth"] = int(arg.split("=")[1])
+        elif arg == "twophase":
+            settings["twophase"] = True
+        elif arg.startswith("discth="):
+            settings["discth"] = int(arg.split("=")[1])
+        elif arg.startswith("plan="):
+            settings["plan"] = arg.split("=", 1)[1]
+        elif arg.startswith("state="):
+            settings["state"] = arg.split("=", 1)[1]
+        elif arg == "resume":
+            settings["resume"] = True
+        elif arg == "reverify":
+            settings["reverify"] = True
+        elif arg == "squeeze":
+            settings["squeeze"] = True
+        elif arg.startswith("ftp="):
+            settings["ftp"] = arg.split("=", 1)[1]
+        elif arg.startswith("mirrors="):
+            settings["mirrors"] = arg.split("=", 1)[1].split(",")
+        elif arg.startswith("srclimit="):
+            settings["srclimit"] = int(arg.split("=")[1])
+        elif arg == "peers":
+            settings["peers"] = True
+        elif arg.startswith("seeds="):
+            settings["seeds"] = int(arg.split("=")[1])
+        elif arg.startswith("pagglimit="):
+            settings["pagglimit"] = int(arg.split("=")[1])
+        elif arg == "batch":
+            settings["batch"] = True
+        elif arg.startswith("prom="):
+            settings["prom"] = arg.split("=", 1)[1]
+        elif arg.startswith("record="):
+            settings["record"] = arg.split("=", 1)[1]
+        elif arg.startswith("replay="):
+            settings["replay"] = arg.split("=", 1)[1]
+        elif arg.startswith("replan="):
+            settings["replan"] = arg.split("=", 1)[1]
+        elif arg.startswith("loginrate="):
+            settings["loginrate"] = float(arg.split("=")[1])
+        elif arg.startswith("regionrate="):
+            settings["regionrate"] = float(arg.split("=")[1])
+        elif arg.startswith("attempts="):
+            settings["attempts"] = int(arg.split("=")[1])
+        elif arg.startswith("backoff="):
+            settings["backoff"] = float(arg.split("=")[1])
+        elif arg.startswith("minrate="):
+            settings["minrate"] = int(arg.split("=")[1])
+        elif arg.startswith("stallwin="):
+            settings["stallwin"] = int(arg.split("=")[1])
+        elif arg.startswith("bangbytes="):
+            settings["bangbytes"] = int(arg.split("=")[1])
+        elif arg.startswith("copyretry="):
+            settings["copyretry"] = int(arg.split("=")[1])
+        elif arg.startswith("workers="):
+            settings["workers"] = int(arg.split("=")[1])
+        elif arg.startswith("hosts="):
+            settings["hosts"] = arg.split("=", 1)[1].split(",")
+        elif arg.startswith("remotedir="):
+            settings["remotedir"] = arg.split("=", 1)[1]
+        elif arg.startswith("shard="):
+            index, total = arg.split("=")[1].split("/")
+            settings["shard"] = (int(index), int(total))
+        elif arg == "worker":
+            settings["worker"] = True
+        elif arg.startswith("runtime="):
+            settings["runtime"] = arg.split("=")[1]
+        elif arg.startswith("sim="):
+            settings["sim"] = int(arg.split("=")[1])
+        elif arg.startswith("simscale="):
+            settings["simscale"] = float(arg.split("=")[1])
+        elif arg.startswith("include="):
+            settings["include"] = re.compile(arg.split("=", 1)[1])
+        elif arg.startswith("exclude="):
+            settings["exclude"] = re.compile(arg.split("=", 1)[1])
+        elif arg.startswith("region="):
+            settings["region"] = arg.split("=", 1)[1].split(",")
+        elif arg.startswith("iprange="):
+            settings["iprange"] = [ipaddress.ip_network(i) for i in arg.split("=", 1)[1].split(",")]
+        elif arg.startswith("failed="):
+            settings["failed"] = arg.split("=", 1)[1]
+        elif arg == "daemon":
+            settings["daemon"] = True
+        elif arg.startswith("poolsize="):
+            settings["poolsize"] = int(arg.split("=")[1])
+        elif arg.startswith("idle="):
+            settings["idle"] = int(arg.split("=")[1])
+        elif arg.startswith("socket="):
+            settings["socket"] = arg.split("=", 1)[1]
+        elif arg.startswith("policy="):
+            settings["policy"] = arg.split("=", 1)[1]
+        elif arg.startswith("status="):
+            settings["status"] = int(arg.split("=")[1])
+        elif arg.startswith("waves="):
+            settings["waves"] = arg.split("=")[1]
+        elif arg.startswith("wavesize="):
+            settings["wavesize"] = int(arg.split("=")[1])
+        elif arg.startswith("maxerr="):
+            settings["maxerr"] = float(arg.split("=")[1])
+        elif arg.startswith("window="):
+            settings["window"] = window_end(arg.split("=")[1])
+        elif arg.startswith("windowguard="):
+            settings["windowguard"] = int(arg.split("=")[1])
+    settings["image_policy"] = compile_policy(load_policy(settings["policy"]))
+    if settings["waves"] and settings["maxerr"] is None:
+        settings["maxerr"] = 0.2
+    window = "no"
+    if settings["window"]:
+        window = (f"{datetime.fromtimestamp(settings['window']).strftime('%Y.%m.%d %H:%M')}, "
+                  f"no squeeze/copy in last {settings['windowguard']} min")
     print()
-    print(f"max threads:...................{settings['maxth']}\n"
+    print(f"engine:........................{settings['engine']}\n"
+          f"max threads:...................{settings['maxth']}\n"
           f"CFG mdoe:......................{settings['cfg']}\n"
-          f"Force mdoe:....................{settings['force']}")
+          f"Force mdoe:....................{settings['force']}\n"
+          f"two phase mode:................{settings['twophase']}\n"
+          f"discovery threads:.............{settings['discth']}\n"
+          f"plan file:.....................{settings['plan']}\n"
+          f"state db:......................{settings['state']}\n"
+          f"resume:........................{settings['resume']}\n"
+          f"reverify md5:..................{settings['reverify']}\n"
+          f"always squeeze:................{settings['squeeze']}\n"
+          f"ftp:...........................{settings['ftp']}\n"
+          f"mirrors:.......................{settings['mirrors']}\n"
+          f"copies per source:.............{settings['srclimit'] or 'no limit'}\n"
+          f"peer copy (seeds per pagg):....{settings['peers']} ({settings['seeds']})\n"
+          f"copies per pagg:...............{settings['pagglimit'] or 'no limit'}\n"
+          f"batch discovery:...............{settings['batch']}\n"
+          f"prometheus textfile:...........{settings['prom']}\n"
+          f"record / replay corpus:........{settings['record']} / {settings['replay']}\n"
+          f"replan from corpus:............{settings['replan']}\n"
+          f"logins per sec global/region:..{settings['loginrate'] or 'no limit'}/{settings['regionrate'] or 'no limit'}\n"
+          f"attempts, backoff:.............{settings['attempts']}, {settings['backoff']}s\n"
+          f"copy min rate / window:........{settings['minrate'] or 'no limit'} bytes/s / {settings['stallwin']}s\n"
+          f"copy retries from other source:{settings['copyretry']}\n"
+          f"workers / hosts:...............{settings['workers'] or 'no'} / {settings['hosts'] or 'local'}\n"
+          f"shard:.........................{'no' if settings['shard'] is None else '/'.join(map(str, settings['shard']))}\n"
+          f"simulated devices:.............{settings['sim'] or 'no'}\n"
+          f"include / exclude hostname:....{settings['include'] and settings['include'].pattern} / "
+          f"{settings['exclude'] and settings['exclude'].pattern}\n"
+          f"region / ip range:.............{settings['region'] or 'all'} / {[str(i) for i in settings['iprange']] or 'all'}\n"
+          f"only failed in run:............{settings['failed'] or 'no'}\n"
+          f"daemon (pool size, idle):......{settings['daemon']} ({settings['poolsize']}, {settings['idle']}s)\n"
+          f"image policy:..................{settings['image_policy']['source']}, "
+          f"groups: {', '.join(settings['image_policy']['groups'])}\n"
+          f"status file refresh:...........{settings['status'] or 'no'}{'s' if settings['status'] else ''}\n"
+          f"waves by / first wave size:....{settings['waves'] or 'no'} / {settings['wavesize']}\n"
+          f"circuit breaker error rate:....{settings['maxerr'] if settings['maxerr'] is not None else 'no'}\n"
+          f"maintenance window end:........{window}")
 
     return settings
 
 
+def window_end(end):
+    # HH:MM, today or tomorrow if it is already over today; returns unix time
+    now = datetime.now()
+    hour, minute = end.split(":")
+    window = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    if window <= now:
+        window += timedelta(days=1)
+    return window.timestamp()
+
+
 def get_user_pw():
     with open("psw.yaml") as file:
         user_psw = yaml.load(file, yaml.SafeLoader)
@@ -79,98 +978,342 @@ def get_user_pw():
     return user_psw[0], user_psw[1]
 
 
-def get_devinfo():
-    devs = []
-    with open("devices.yaml", "r") as file:
-        devices_info = yaml.load(file, yaml.SafeLoader)
-        for hostname, ip_address in devices_info.items():
-            dev = CellSiteGateway(ip=ip_address, host=hostname)
-            devs.append(dev)
+DEFAULT_POLICY_FILE = "policy.yaml"
+# built-in image policy, used if there is no policy.yaml
+DEFAULT_POLICY = {
+    "images": {"asr901-universalk9-mz.156-2.SP9.bin": "d2864fe9a1725cde1d12d7e237b6be2f",
+               "asr901-universalk9-mz.155-3.S10.bin": "87d293427559873cb5e7f36ec1599733"},
+    "groups": {"default": {"primary": "asr901-universalk9-mz.156-2.SP9.bin",
+                           "backup": "asr901-universalk9-mz.155-3.S10.bin"},
+               "xe": {"primary": "asr901-universalk9-mz.155-3.S10.bin",
+                      "paggs": ["alma-003001-pagg-1", "alma-004001-pagg-1", "alma-006001-pagg-1",
+                                "alma-062001-pagg-1", "alma-020001-pagg-1", "alma-023001-pagg-1",
+                                "alma-051001-pagg-1", "alma-040001-pagg-1", "alma-048001-pagg-1",
+                                "alma-052001-pagg-1", "alma-073001-pagg-1", "alma-521001-pagg-1",
+                                "asta-032001-pagg-1", "asta-032001-pagg-2", "asta-036001-pagg-1",
+                                "asta-036001-pagg-2", "asta-038001-pagg-1", "asta-240001-pagg-1",
+                                "asta-240001-pagg-2"]}}}
+
+
+def load_policy(policy_file):
+    # only missing default file falls back to the built-in policy, policy= file must exist
+    if policy_file == DEFAULT_POLICY_FILE and not Path(policy_file).is_file():
+        return dict(DEFAULT_POLICY, source="built-in")
+    if not Path(policy_file).is_file():
+        raise FileNotFoundError(f"image policy file not found: {policy_file}")
+    with open(policy_file) as file:
+        return dict(yaml.load(file, yaml.SafeLoader), source=policy_file)
+
+
+def compile_policy(policy):
+    # pagg hostname: target of its group, planning of a device is one dict lookup.
+    # the group without paggs is the default one (devices behind other paggs or without pagg)
+    images = policy["images"]
+    index = {"source": policy.get("source", "built-in"), "groups": {}, "paggs": {}, "default": None}
+    for name, group in policy["groups"].items():
+        target = {"group": sys.intern(name),
+                  "primary": sys.intern(group["primary"]),
+                  "backup": sys.intern(group["backup"]) if group.get("backup") else None,
+                  "md5": {}}
+        for image in (target["primary"], target["backup"]):
+            if image is None:
+                continue
+            if image not in images:
+                raise ValueError(f"image policy: no md5 for {image} (group {name})")
+            target["md5"][image] = images[image]
+        index["groups"][name] = target
+        if not group.get("paggs"):
+            if index["default"] is not None:
+                raise ValueError(f"image policy: two groups without paggs: {index['default']['group']}, {name}")
+            index["default"] = target
+        for pagg in group.get("paggs", []):
+            if pagg in index["paggs"]:
+                raise ValueError(f"image policy: {pagg} is in groups {index['paggs'][pagg]['group']} and {name}")
+            index["paggs"][pagg] = target
+    if index["default"] is None:
+        raise ValueError("image policy: no default group (group without paggs)")
+    return index
+
+
+def iter_inventory(file_name):
+    # devices.yaml is parsed event by event: "hostname: ip" pairs are yielded without loading the whole file
+    key = None
+    depth = 0
+    with open(file_name, "r") as file:
+        for event in yaml.parse(file, yaml.SafeLoader):
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                depth += 1
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                depth -= 1
+            elif isinstance(event, yaml.ScalarEvent) and depth == 1:
+                if key is None:
+                    key = event.value
+                else:
+                    yield key, event.value
+                    key = None
+
+
+def failed_hosts(run):
+    # hostnames which failed in a previous run: results.jsonl, error log file or run prefix (logs/<date>/<time>)
+    path = Path(run)
+    if path.is_file():
+        files = [path]
+    elif Path(f"{run}_results.jsonl").is_file():
+        files = [Path(f"{run}_results.jsonl")]
+    else:
+        files = [file for file in (Path(f"{run}_error_logs.txt"), Path(f"{run}_connection_error_msg.txt"))
+                 if file.is_file()]
+    if not files:
+        raise FileNotFoundError(f"no results or error logs of run: {run}")
+    hostnames = set()
+    for file_name in files:
+        with open(file_name) as file:
+            if file_name.suffix == ".jsonl":
+                for line in file:
+                    record = json.loads(line)
+                    if not record["connection_status"] or record["error"]:
+                        hostnames.add(record["hostname"])
+            else:
+                separator = False
+                for line in file:
+                    if separator and " : " in line:
+                        hostnames.add(line.split(" : ")[0].strip())
+                    separator = line.startswith("-" * 80)
+    return hostnames
+
+
+def select_inventory(inventory, settings):
+    # filters (hostname, ip) pairs before device objects are created, shard is taken from selected devices
+    failed = failed_hosts(settings["failed"]) if settings["failed"] else None
+    number = 0
+    for hostname, ip_address in inventory:
+        if settings["include"] and not settings["include"].search(hostname):
+            continue
+        if settings["exclude"] and settings["exclude"].search(hostname):
+            continue
+        if settings["region"] and not hostname.startswith(tuple(settings["region"])):
+            continue
+        if settings["iprange"] and not in_iprange(ip_address, settings["iprange"]):
+            continue
+        if failed is not None and hostname not in failed:
+            continue
+        number += 1
+        if settings["shard"] is not None and (number - 1) % settings["shard"][1] != settings["shard"][0]:
+            continue
+        yield hostname, ip_address
+
+
+def in_iprange(ip_address, networks):
+    try:
+        ip_address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return False
+    return any(ip_address in network for network in networks)
+
+
+def get_devinfo(settings):
+    devs = [CellSiteGateway(ip=ip_address, host=hostname)
+            for hostname, ip_address in select_inventory(iter_inventory("devices.yaml"), settings)]
     print()
     return devs
 
 
-def write_logs(devs, log_folder, settings):    
-    failed_connection = 0
-    errors = 0
-    timenow = datetime.now()
-    current_date = timenow.strftime("%Y.%m.%d")
-    current_time = timenow.strftime("%H.%M.%S")
-    folder = f"logs/{current_date}"
-    if not os.path.exists(folder):
-        os.mkdir(folder)
+PLAN_FIELDS = ("hostname", "ip_address", "connection_status", "connection_error_msg", "connection_error_type",
+               "ios_list", "sfp_vendor_cisco", "sfp_vendor", "error", "error_msg", "policy_group",
+               "current_ios", "md5", "ios_copied", "boot", "ios_to_delete", "delete_files",
+               "current_boot", "check_squeeze", "discovered", "md5_correct", "squeeze_result",
+               "last_step", "flash_sizes", "flash_total", "flash_free", "flash_deleted",
+               "squeeze_needed", "squeeze_reason", "squeeze_saved", "pagg", "copy_source",
+               "discovery_commands", "discovery_commands_legacy", "discovery_time",
+               "delete_result", "timings", "copy_rate", "deferred")
 
-    err_msg = log_folder / f"{current_time}_connection_error_msg.txt"
-    log = log_folder / f"{current_time}_logs.txt"
-    error = log_folder / f"{current_time}_error_logs.txt"
-    vendor = log_folder / f"{current_time}_sfp_vendor.txt"
 
-    err_msg_file = open(err_msg, "w")
-    err_msg_file.write(f"{current_date} {current_time}\n\n")
+def dev_to_dict(dev):
+    return {field: getattr(dev, field) for field in PLAN_FIELDS}
 
-    log_file = open(log, "w")
-    log_file.write(f"{current_date} {current_time}\n\n")
 
-    error_file = open(error, "w")
-    error_file.write(f"{current_date} {current_time}\n\n")
+def dev_from_dict(data):
+    dev = CellSiteGateway(ip=data["ip_address"], host=data["hostname"])
+    for field in PLAN_FIELDS:
+        if field in data:
+            setattr(dev, field, data[field])
+    for field in ("current_ios", "ios_copied", "boot", "current_boot"):
+        if getattr(dev, field):
+            setattr(dev, field, sys.intern(getattr(dev, field)))
+    dev.ios_list = [sys.intern(i) for i in dev.ios_list]
+    dev.ios_to_delete = [sys.intern(i) for i in dev.ios_to_delete]
+    dev.flash_sizes = {sys.intern(name): size for name, size in dev.flash_sizes.items()}
+    return dev
 
-    vendor_file = open(vendor, "w")
-    vendor_file.write(f"{current_date} {current_time}\n\n")
 
-    for dev in devs:
-        if not dev.connection_status:
-            failed_connection += 1
-            err_msg_file.write("-" * 80 + "\n")
-            err_msg_file.write(f"{dev.hostname} : {dev.ip_address}\n\n")
-            err_msg_file.write(f"{dev.connection_error_msg}\n")
-        else:
-            log_file.write("-" * 80 + "\n")
-            log_file.write(f"{dev.hostname} : {dev.ip_address}\n\n")
-            log_file.write("".join(dev.logging))
-            log_file.write("\n\n")
-            vendor_file.write(f"{dev.hostname}: {dev.sfp_vendor}\n")
-        if dev.error:
-            errors += 1
-            error_file.write("-" * 80 + "\n")
-            error_file.write(f"{dev.hostname} : {dev.ip_address}\n\n")
-            error_file.write(pformat(dev.error_msg))
-            error_file.write("\n\n")
+def write_plan(devs, plan_file):
+    with open(plan_file, "w") as file:
+        json.dump([dev_to_dict(dev) for dev in devs], file, indent=1)
 
-    err_msg_file.close()
-    log_file.close()
-    error_file.close()
-    vendor_file.close()
 
-    if not settings["cfg"]:
-        log.unlink() 
+def load_plan(plan_file, settings):
+    with open(plan_file) as file:
+        plan = {data["hostname"]: data for data in json.load(file)}
+    selected = select_inventory(((hostname, data["ip_address"]) for hostname, data in plan.items()), settings)
+    devs = [dev_from_dict(plan[hostname]) for hostname, _ in selected]
+    for dev in devs:
+        if not dev.discovered:
+            # discovery failed in the previous run, try again from scratch
+            dev.connection_status = True
+            dev.connection_error_msg = ""
+    print()
+    return devs
 
-    if all([dev.connection_status is True for dev in devs]):
-        err_msg.unlink()
 
-    if all([dev.error is False for dev in devs]):
-        error.unlink()
+def resume_devices(devs, store, settings):
+    # returns devices which are not finished yet, restored from the state store
+    pending = []
+    for dev in devs:
+        state = store.load(dev.hostname)
+        if state is None:
+            pending.append(dev)
+            continue
+        restored = dev_from_dict(state)
+        restored.ip_address = dev.ip_address
+        restored.connection_status = True
+        restored.connection_error_msg = ""
+        restored.deferred = ""
+        if finished(restored, settings):
+            print(f"{dev.hostname:25}{dev.ip_address:17}finished in previous run, skipped")
+        else:
+            if restored.last_step:
+                print(f"{dev.hostname:25}{dev.ip_address:17}resume after step: {restored.last_step}")
+            pending.append(restored)
+    return pending
 
-    return failed_connection, errors
+
+def interleave(devs):
+    # round robin over PAGGs (region if PAGG is not discovered yet), so copies are spread over uplinks
+    groups = {}
+    for dev in devs:
+        groups.setdefault(dev.pagg or dev.hostname.split("-")[0], []).append(dev)
+    ordered = []
+    for i in range(max([len(group) for group in groups.values()], default=0)):
+        for group in groups.values():
+            if i < len(group):
+                ordered.append(group[i])
+    return ordered
+
+
+def dev_record(dev):
+    record = dev_to_dict(dev)
+    record["logging"] = "".join(dev.logging)
+    record["commands"] = dev.commands
+    record["md5_cache"] = dev.md5_cache
+    return record
+
+
+RECORD_PREFIX = "@@record "  # worker sends finished devices to the coordinator as lines on its stderr
+output_lock = Lock()
+
+
+def finish_device(dev, settings, configured=False):
+    # device is written to the log files right away and its transcript is released.
+    # only devices which were configured count for the circuit breaker, not read-only discovery
+    record = dev_record(dev)
+    if settings.get("metrics"):
+        settings["metrics"].add(record)
+    if settings.get("progress"):
+        settings["progress"].done(record)
+    if configured and settings.get("breaker"):
+        settings["breaker"].add(record)
+    if settings.get("logwriter"):
+        settings["logwriter"].write(record)
+    if settings.get("worker"):
+        with output_lock:
+            settings["record_channel"].write(RECORD_PREFIX + json.dumps(record) + "\n")
+            settings["record_channel"].flush()
+    dev.logging = []
+    dev.commands = []
 
 
 #######################################################################################
 # ------------------------------ def         -----------------------------------------#
 #######################################################################################
 
+FREE_SPACE_REQUIRED = 46000000  # bytes needed to copy a new IOS image
+SQUEEZE_BYTES_PER_SEC = 100000  # rough squeeze speed on ASR901 flash, used to predict squeeze time
+COPY_POLL_INTERVAL = 1  # seconds between reads of copy output
+COPY_SLOT_WAIT = 5  # max seconds a thread waits before a device with no free copy source is queued again
+
+
+DIR_FLASH = r"dir flash:"
+SH_UPLINK = r"sh int descr | in UPLINK|pagg|csg"
+SH_PAGG = r"sh isis hostname | in pagg"
+SH_VER = r"sh ver | in Cisco IOS Software"
+SH_BOOT = r"sh run | in boot system flash"
+DIR_ALL = r"dir /a"
+BATCH_END = "! batch end"  # comment line, IOS ignores it, used to find the end of batch output
+
+
+def send_batch(connection, commands, read_timeout=20):
+    # all commands in one write, one read until the prompt after BATCH_END
+    prompt = f"{connection.base_prompt}#"
+    connection.write_channel("\n".join(commands + [BATCH_END]) + "\n")
+    output = connection.read_until_pattern(pattern=re.escape(BATCH_END) + r"\s+" + re.escape(prompt),
+                                           read_timeout=read_timeout * len(commands))
+    results = {cmd: [] for cmd in commands}
+    pending = list(commands)
+    current = None
+    for line in output.splitlines():
+        if pending and line.rstrip().endswith(pending[0]) and (line.startswith(prompt) or current is None):
+            current = pending.pop(0)
+        elif line.startswith(prompt):
+            current = None
+        elif current:
+            results[current].append(line)
+    return {cmd: "\n".join(lines) for cmd, lines in results.items()}
+
+
 def dir_ios(dev, connection):
-    dirflash = connection.send_command(r"dir flash:", read_timeout=20)
-    compile = re.compile(r"\d+ +\S+ +\d+ +.* (\S+)")
+    dir_ios_parse(dev, connection.send_command(DIR_FLASH, read_timeout=20))
+
+
+def dir_ios_parse(dev, dirflash):
+    compile = re.compile(r"\d+ +\S+ +(\d+) +.* (\S+)")
     for line in dirflash.splitlines():
         match = re.search(compile, line)
         if match:
-            if ".bin" in match[1]:
-                dev.ios_list.append(match[1])
-            elif ".lic" not in match[1]:
-                dev.delete_files.append(match[1])
+            dev.flash_sizes[sys.intern(match[2])] = int(match[1])
+            if ".bin" in match[2]:
+                dev.ios_list.append(sys.intern(match[2]))
+            elif ".lic" not in match[2]:
+                dev.delete_files.append(match[2])
+        elif line.endswith(r"bytes free)"):
+            dev.flash_total = int(line.split()[0])
+            dev.flash_free = int(line.split()[-3][1:])
+
+
+def flash_files(dirflash):
+    # file name: size
+    compile = re.compile(r"\d+ +\S+ +(\d+) +.* (\S+)")
+    files = {}
+    for line in dirflash.splitlines():
+        match = re.search(compile, line)
+        if match:
+            files[match[2]] = int(match[1])
+    return files
+
+
+def file_size(connection, filename):
+    dirfile = connection.send_command(f"dir flash:{filename}", read_timeout=20)
+    return flash_files(dirfile).get(filename)
     
 
 def controller(dev, connection):
-    show_uplink = connection.send_command(r"sh int descr | in UPLINK|pagg|csg", read_timeout=20)
+    ports = uplink_ports(connection.send_command(SH_UPLINK, read_timeout=20))
+    show_controllers = [connection.send_command(f"sh controllers {port} | in vendor_name", read_timeout=20)
+                        for port in ports]
+    controller_parse(dev, ports, show_controllers)
+    return ports
+
+
+def uplink_ports(show_uplink):
     uplink = ["pagg", "UPLINK", "csg"]
     ports = []
 
@@ -179,9 +1322,11 @@ def controller(dev, connection):
             p = line.split()[0]
             if "Vl" not in p and "Po" not in p:
                 ports.append(p)
+    return ports
 
-    for port in ports:
-        show_controller = connection.send_command(f"sh controllers {port} | in vendor_name", read_timeout=20)
+
+def controller_parse(dev, ports, show_controllers):
+    for show_controller in show_controllers:
         for i in show_controller.splitlines():
             if "vendor_name" in i:
                 if "CISCO" in i:
@@ -198,40 +1343,21 @@ def controller(dev, connection):
         dev.error_msg.append(f"vendor name is not found: {ports} {dev.sfp_vendor}")
 
 
-def define_pagg_xe(dev, connection):
-    pagg = connection.send_command(r"sh isis hostname | in pagg", read_timeout=20)
-    
-    xe = ("alma-003001-pagg-1",
-          "alma-004001-pagg-1",
-          "alma-006001-pagg-1",
-          "alma-062001-pagg-1",
-          "alma-020001-pagg-1",
-          "alma-023001-pagg-1",
-          "alma-051001-pagg-1",
-          "alma-040001-pagg-1",
-          "alma-048001-pagg-1",
-          "alma-052001-pagg-1",
-          "alma-073001-pagg-1",
-          "alma-521001-pagg-1",
-          "asta-032001-pagg-1",
-          "asta-032001-pagg-2",
-          "asta-036001-pagg-1",
-          "asta-036001-pagg-2",
-          "asta-038001-pagg-1",
-          "asta-240001-pagg-1",
-          "asta-240001-pagg-2")
-          
+def define_pagg(dev, connection):
+    define_pagg_parse(dev, connection.send_command(SH_PAGG, read_timeout=20))
+
+
+def define_pagg_parse(dev, pagg):
     for i in pagg.splitlines():
         if "pagg" in i:
-            p = i.split()[-1]
-            if p in xe:
-                dev.pagg_xe = True
-            else:
-                dev.pagg_xe = False
-            
+            dev.pagg = i.split()[-1]
+
 
 def current_ios(dev, connection):
-    current_ios_log = connection.send_command(f"sh ver | in Cisco IOS Software", read_timeout=20)
+    current_ios_parse(dev, connection.send_command(SH_VER, read_timeout=20))
+
+
+def current_ios_parse(dev, current_ios_log):
     compile = re.compile(r"Version (\S+),")
 
     for a in current_ios_log.splitlines():
@@ -241,123 +1367,122 @@ def current_ios(dev, connection):
             i1 = current_ios_version.replace(".", "")
             i2 = i1.replace("(", "-")
             i3 = i2.replace(")", ".")
-            dev.current_ios = f"asr901-universalk9-mz.{i3}.bin"
+            dev.current_ios = sys.intern(f"asr901-universalk9-mz.{i3}.bin")
 
 
 def current_boot(dev, connection):
-    boot = connection.send_command(f"sh run | in boot system flash", read_timeout=20)
+    current_boot_parse(dev, connection.send_command(SH_BOOT, read_timeout=20))
+
+
+def current_boot_parse(dev, boot):
     for i in boot.splitlines():
         if "bin" in i:
-            dev.current_boot = i.split()[-1]
+            dev.current_boot = sys.intern(i.split()[-1])
 
 
 def check_squeeze(dev, connection):
-    log = connection.send_command(f"dir /a", read_timeout=20)
+    check_squeeze_parse(dev, connection.send_command(DIR_ALL, read_timeout=20))
+
+
+def check_squeeze_parse(dev, log):
+    compile = re.compile(r"\d+ +\S+ +(\d+) +.* \[\S+\]")
     for i in log.splitlines():
         if "[" and "]" in i:
             dev.check_squeeze = True
-            break
-
-
-def parse_lst(dev):
-    if dev.pagg_xe:
-        if dev.current_boot != "asr901-universalk9-mz.155-3.S10.bin":
-            dev.boot = "asr901-universalk9-mz.155-3.S10.bin"
-        if dev.current_ios == "asr901-universalk9-mz.155-3.S10.bin":
-            correct_ios = ("asr901-universalk9-mz.155-3.S10.bin")
-        else:
-            correct_ios = ("asr901-universalk9-mz.155-3.S10.bin", dev.current_ios)
-            if "asr901-universalk9-mz.155-3.S10.bin" not in dev.ios_list:
-                dev.ios_copied = "asr901-universalk9-mz.155-3.S10.bin"
+            match = re.search(compile, i)
+            if match:
+                dev.flash_deleted += int(match[1])
+
+
+def plan_squeeze(dev, settings):
+    # deleted files keep their space until squeeze, so only squeeze if the copy does not fit otherwise
+    if not (dev.check_squeeze or dev.ios_to_delete or dev.delete_files):
+        dev.squeeze_reason = "nothing to squeeze"
+        return
+    if settings["squeeze"]:
+        dev.squeeze_needed = True
+        dev.squeeze_reason = "always squeeze"
+        return
+
+    reclaim = dev.flash_deleted + sum(dev.flash_sizes.get(i, 0) for i in dev.ios_to_delete + dev.delete_files)
+    if not dev.ios_copied:
+        dev.squeeze_reason = "nothing to copy"
+    elif dev.flash_free > FREE_SPACE_REQUIRED:
+        dev.squeeze_reason = f"copy fits without squeeze, free: {dev.flash_free}"
     else:
-        if dev.current_boot != "asr901-universalk9-mz.156-2.SP9.bin":
-            dev.boot = "asr901-universalk9-mz.156-2.SP9.bin"
-        if dev.current_ios == "asr901-universalk9-mz.156-2.SP9.bin":
-            correct_ios = ("asr901-universalk9-mz.156-2.SP9.bin", "asr901-universalk9-mz.155-3.S10.bin")
-            if "asr901-universalk9-mz.155-3.S10.bin" not in dev.ios_list:
-                dev.ios_copied = "asr901-universalk9-mz.155-3.S10.bin"
-        elif dev.current_ios == "asr901-universalk9-mz.155-3.S10.bin":
-            correct_ios = ("asr901-universalk9-mz.156-2.SP9.bin", "asr901-universalk9-mz.155-3.S10.bin")
-            if "asr901-universalk9-mz.156-2.SP9.bin" not in dev.ios_list:
-                dev.ios_copied = "asr901-universalk9-mz.156-2.SP9.bin"
-        else:
-            correct_ios = ("asr901-universalk9-mz.156-2.SP9.bin", dev.current_ios)
-            if "asr901-universalk9-mz.156-2.SP9.bin" not in dev.ios_list:
-                dev.ios_copied = "asr901-universalk9-mz.156-2.SP9.bin"
+        dev.squeeze_needed = True
+        dev.squeeze_reason = f"copy needs squeeze, free: {dev.flash_free}, after squeeze: {dev.flash_free + reclaim}"
+        return
+
+    used = max(dev.flash_total - dev.flash_free - reclaim, 0)
+    dev.squeeze_saved = min(int(used / SQUEEZE_BYTES_PER_SEC), 1500)
+
+
+def plan_images(dev, policy):
+    # policy target of the pagg: boot primary image, keep primary and backup (or current) image,
+    # copy the one of them which is missing, delete other images
+    target = policy["paggs"].get(dev.pagg, policy["default"])
+    primary, backup = target["primary"], target["backup"]
+    dev.policy_group = target["group"]
+    if dev.current_boot != primary:
+        dev.boot = primary
+    if dev.current_ios == primary:
+        correct_ios = (primary, backup)
+        if backup and backup not in dev.ios_list:
+            dev.ios_copied = backup
+    else:
+        correct_ios = (primary, backup if dev.current_ios == backup else dev.current_ios)
+        if primary not in dev.ios_list:
+            dev.ios_copied = primary
 
     for i in dev.ios_list:
         if i not in correct_ios:
             dev.ios_to_delete.append(i)
 
-    if dev.ios_copied == "asr901-universalk9-mz.155-3.S10.bin":
-        dev.md5 = "87d293427559873cb5e7f36ec1599733"
-    elif dev.ios_copied == "asr901-universalk9-mz.156-2.SP9.bin":
-        dev.md5 = "d2864fe9a1725cde1d12d7e237b6be2f"
+    # md5 of the image check_md5 verifies: copied one, or boot target if it is already in flash
+    verified = dev.ios_copied or dev.boot
+    if verified:
+        dev.md5 = target["md5"][verified]
 
 
-def short_ios(dev):
-    compile = re.compile(r"mz.(\S+).bin")
+SHORT_IOS = re.compile(r"mz.(\S+).bin")
 
-    match_ios = re.search(compile, dev.current_ios)
-    if match_ios:
-        dev.current_ios_short = match_ios[1]
 
-    match_copied = re.search(compile, dev.ios_copied)
-    if match_copied:
-        dev.ios_copied_short = match_copied[1]
+def ios_short(name):
+    # asr901-universalk9-mz.156-2.SP9.bin -> 156-2.SP9
+    match = SHORT_IOS.search(name or "")
+    if match:
+        return match[1]
+    return None
 
-    match_boot = re.search(compile, dev.boot)
-    if match_boot:
-        dev.boot_short = match_boot[1]
 
-    match_curr_boot = re.search(compile, dev.current_boot)
-    if match_curr_boot:
-        dev.current_boot_short = match_curr_boot[1]
+def delete_ios(dev, connection, settings):
+    # delete /force does not ask for confirmation, so all files go in one batch
+    files = dev.ios_to_delete + dev.delete_files
+    if not files:
+        return
+    if settings.get("store"):
+        for i in files:
+            settings["store"].md5_forget(dev.hostname, i)
 
-    for i in dev.ios_to_delete:
-        match = re.search(compile, i)
-        if match:
-            dev.ios_to_delete_short.append(match[1])      
-
-    for j in dev.ios_list:
-        match_list = re.search(compile, j)
-        if match_list:
-            dev.ios_list_short.append(match_list[1])   
-
-
-def delete_ios(dev, connection):
-    if dev.ios_to_delete:
-        for i in dev.ios_to_delete:
-            dev.logging.append(connection.send_command(f"delete flash:{i}", 
-                                                        expect_string=r"Delete filename",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
-            dev.logging.append(connection.send_command("", 
-                                                        expect_string=r"confirm",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
-            dev.logging.append(connection.send_command("", 
-                                                        expect_string=r"#",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
-    if dev.delete_files:
-        for j in dev.delete_files:
-            dev.logging.append(connection.send_command(f"delete flash:{j}", 
-                                                        expect_string=r"Delete filename",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
-            dev.logging.append(connection.send_command("", 
-                                                        expect_string=r"confirm",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
-            dev.logging.append(connection.send_command("", 
-                                                        expect_string=r"#",
-                                                        strip_command=False, strip_prompt=False, 
-                                                        read_timeout=20))
+    commands = [f"delete /force flash:{i}" for i in files]
+    result = send_batch(connection, commands)
+    for cmd in commands:
+        dev.logging.append(f"{cmd}\n{result[cmd]}\n")
+
+    in_flash = flash_files(connection.send_command(DIR_FLASH, read_timeout=20))
+    for i in files:
+        dev.delete_result[i] = i not in in_flash
+        dev.logging.append(f"delete {i}: {'ok' if dev.delete_result[i] else 'failed, file is still in flash'}\n")
+    failed = [i for i in files if not dev.delete_result[i]]
+    if failed:
+        print(f"{dev.hostname:25}{dev.ip_address:17}[ERROR] delete failed: {failed}")
+        dev.error = True
+        dev.error_msg.append(f"delete failed: {failed}")
 
 
 def squeeze(dev, connection):
-    if dev.check_squeeze or dev.ios_to_delete or dev.delete_files:
+    if dev.squeeze_needed:
         dev.logging.append(connection.send_command("squeeze flash:", expect_string=r"confirm",
                                                     strip_command=False, strip_prompt=False, 
                                                     read_timeout=20))
@@ -384,16 +1509,39 @@ def copy(dev, connection, settings):
                 free_space = int(line.split()[-3][1:])
 
         if dev.ios_copied:
-            if free_space > 46000000:
-                dev.logging.append(connection.send_command(f"copy ftp://212.19.149.62/{dev.ios_copied} flash:",
-                                                            expect_string=r"Destination filename",
-                                                            strip_command=False, strip_prompt=False,
-                                                            read_timeout=20))
-                dev.logging.append(connection.send_command("", expect_string=r"#",
-                                                            strip_command=False, strip_prompt=False,
-                                                            read_timeout=1500))
-
-                
+            if free_space > FREE_SPACE_REQUIRED:
+                distributor = settings.get("distributor")
+                source = settings["ftp"]
+                if distributor:
+                    source = dev.copy_slot or distributor.try_acquire(dev)
+                    dev.copy_slot = ""
+                if source is None:
+                    copy_requeue(dev)
+                    return
+                dev.copy_source = source
+                failed_sources = []
+                while True:
+                    try:
+                        copied = copy_transfer(dev, connection, source, settings)
+                    finally:
+                        if distributor:
+                            distributor.release(dev, source)
+                    if copied:
+                        break
+                    failed_sources.append(source)
+                    if not distributor or len(failed_sources) > settings["copyretry"]:
+                        print(f"{dev.hostname:25}{dev.ip_address:17}[ERROR] copy failed: {failed_sources}")
+                        dev.error = True
+                        dev.error_msg.append(f"copy failed: {failed_sources}, {dev.copy_rate} bytes/s")
+                        break
+                    # stalled or failed transfer, try again from another source if there is one
+                    source = distributor.try_acquire(dev, exclude=failed_sources)
+                    if source is None:
+                        copy_requeue(dev)
+                        return
+                    dev.copy_source = source
+                    print(f"{dev.hostname:25}{dev.ip_address:17}copy failed, retry from {source}")
+
             else:
                 print(f"{dev.hostname:25}{dev.ip_address:17}[ERROR] no free space: {free_space}")
                 dev.error = True
@@ -405,14 +1553,103 @@ def copy(dev, connection, settings):
         dev.error_msg.append(f"uplink sfp transceiver vendor is not cisco: {dev.sfp_vendor}")
 
 
-def check_md5(dev, connection):
-    if dev.ios_copied:
-        md5_log = connection.send_command(f"verify /md5 {dev.ios_copied}",
+def copy_requeue(dev):
+    # all sources are busy: the session is closed and the device comes back later,
+    # threads and ssh sessions are not held waiting for a copy slot
+    dev.requeue = True
+    dev.logging.append("no free copy source, device is queued again\n")
+
+
+def copy_next(dev):
+    # copy is the next long step of a planned or resumed device
+    return (dev.discovered and bool(dev.ios_copied) and not step_done(dev, "copy")
+            and (step_done(dev, "squeeze") or not dev.squeeze_needed))
+
+
+def copy_transfer(dev, connection, source, settings):
+    # reads copy output while it comes, "!" is printed every bangbytes bytes.
+    # transfer is aborted if it is slower than minrate for stallwin seconds
+    if settings.get("store"):
+        # file is overwritten, md5 verified before does not count any more
+        settings["store"].md5_forget(dev.hostname, dev.ios_copied)
+    dev.logging.append(connection.send_command(f"copy {source}{dev.ios_copied} flash:",
+                                                expect_string=r"Destination filename",
+                                                strip_command=False, strip_prompt=False,
+                                                read_timeout=20))
+    connection.write_channel("\n")
+    prompt = re.compile(rf"{re.escape(connection.base_prompt)}#\s*$")
+    output = ""
+    start = time.monotonic()
+    samples = [(start, 0)]  # (time, bytes) of the last stallwin seconds
+    stalled = False
+    while not re.search(prompt, output):
+        time.sleep(COPY_POLL_INTERVAL)
+        output += connection.read_channel()
+        now = time.monotonic()
+        copied_bytes = output.count("!") * settings["bangbytes"]
+        samples.append((now, copied_bytes))
+        while samples[0][0] < now - settings["stallwin"]:
+            samples.pop(0)
+        if now - start > 1500:
+            stalled = True
+        elif settings["minrate"] and now - start >= settings["stallwin"]:
+            window_time, window_bytes = samples[0]
+            rate = (copied_bytes - window_bytes) / max(now - window_time, 1)
+            stalled = rate < settings["minrate"]
+        if stalled:
+            connection.write_channel("\x1e")  # ctrl-^ breaks the transfer
+            output += connection.read_until_pattern(pattern=prompt.pattern, read_timeout=60)
+            dev.logging.append(output)
+            copy_cleanup(dev, connection, settings)
+            dev.copy_rate = int(copied_bytes / (now - start))
+            return False
+
+    dev.logging.append(output)
+    match = re.search(r"(\d+) bytes copied in ([\d.]+) secs", output)
+    if "%Error" in output or not match:
+        # %Error opening (no file on the source), %Error copying (not enough space), %Error reading (I/O error):
+        # the prompt comes back, partial file is deleted and the copy is failed like a stalled one
+        copy_cleanup(dev, connection, settings)
+        copied_bytes = output.count("!") * settings["bangbytes"]
+        dev.copy_rate = int(copied_bytes / (time.monotonic() - start)) if copied_bytes else None
+        return False
+    if float(match[2]):
+        dev.copy_rate = int(int(match[1]) / float(match[2]))
+    else:
+        dev.copy_rate = int(output.count("!") * settings["bangbytes"] / (time.monotonic() - start))
+    return True
+
+
+def copy_cleanup(dev, connection, settings):
+    # partial image of a failed copy is deleted, it must not be taken for a copied one
+    dev.logging.append(connection.send_command(f"delete /force flash:{dev.ios_copied}",
+                                                strip_command=False, strip_prompt=False,
+                                                read_timeout=20))
+    if settings.get("store"):
+        settings["store"].md5_forget(dev.hostname, dev.ios_copied)
+
+
+def check_md5(dev, connection, settings):
+    # copied image, or boot target which is in flash already (re-run after the copy)
+    image = dev.ios_copied or dev.boot
+    if image and dev.md5:
+        store = settings.get("store")
+        size = file_size(connection, image)
+        if store and not settings["reverify"]:
+            hit = store.md5_cached(dev.hostname, image, size, dev.md5)
+            dev.md5_cache = "hit" if hit else "miss"
+            if hit:
+                dev.logging.append(f"verify /md5 {image}: skipped, verified before (size {size})\n")
+                dev.md5_correct = True
+                return
+        md5_log = connection.send_command(f"verify /md5 {image}",
                                         strip_command=False, strip_prompt=False,
                                         read_timeout=1500)                           
         dev.logging.append(md5_log)
         if dev.md5 in md5_log:
             dev.md5_correct = True
+            if store and size is not None:
+                store.md5_save(dev.hostname, image, size, dev.md5)
         else:
             dev.error = True
             dev.error_msg.append("md5 checksum failed")
@@ -431,77 +1668,403 @@ def set_boot(dev, connection):
             dev.logging.append(connection.send_command("\n", expect_string=r"#"))
 
 
-def del_squeeze_copy(dev, connection, settings):
-    dir_ios(dev, connection)
-    controller(dev, connection)
-    define_pagg_xe(dev, connection)
-    current_ios(dev, connection)
-    current_boot(dev, connection)
-    check_squeeze(dev, connection)
-    parse_lst(dev)
-    short_ios(dev)
+STEPS = ("discovery", "delete_ios", "squeeze", "copy", "check_md5", "set_boot")
 
-    if settings["cfg"]:
-        delete_ios(dev, connection)
-        squeeze(dev, connection)
-        copy(dev, connection, settings)
-        check_md5(dev, connection)
-        set_boot(dev, connection)
-        
-        print(f"{dev.hostname:25}{dev.ip_address:17}current ios:...................{dev.current_ios_short}\n"
-                                           f"{'':42}ios in flash:..................{dev.ios_list_short}\n"
-                                           f"{'':42}ios to delete:.................{dev.ios_to_delete_short}\n"
-                                           f"{'':42}ios copied:....................{dev.ios_copied_short}\n"
-                                           f"{'':42}boot current/new:..............{dev.current_boot_short}/{'didnt change' if dev.boot == '' else dev.boot_short}\n"
-                                           f"{'':42}md5 correct:...................{dev.md5_correct}\n"
-                                           f"{'':42}squeeze result:................{dev.squeeze_result}\n"
-                                           f"{'':42}all sfp cisco:.................{all(dev.sfp_vendor_cisco)}/{dev.sfp_vendor}\n"
-                                           f"{'':42}delete files:..................{dev.delete_files}") 
 
+def step_done(dev, step):
+    return dev.last_step is not None and STEPS.index(dev.last_step) >= STEPS.index(step)
+
+
+def finished(dev, settings):
+    return step_done(dev, "set_boot" if settings["cfg"] else "discovery")
+
+
+def save_state(dev, settings):
+    if settings.get("store"):
+        settings["store"].save(dev)
+
+
+def add_timing(dev, step, start):
+    dev.timings[step] = round(dev.timings.get(step, 0) + time.monotonic() - start, 3)
+
+
+def run_step(dev, settings, step, func, *args):
+    if step_done(dev, step):
+        return
+    if settings.get("progress"):
+        settings["progress"].stage(dev, step)
+    start = time.monotonic()
+    func(*args)
+    add_timing(dev, step, start)
+    if dev.requeue:
+        # step runs again when the device comes back from the queue
+        return
+    dev.last_step = step
+    save_state(dev, settings)
+
+
+def discovery_batch(dev, connection):
+    # two round trips: all show commands, then sh controllers for all uplink ports
+    show = send_batch(connection, [DIR_FLASH, SH_UPLINK, SH_PAGG, SH_VER, SH_BOOT, DIR_ALL])
+    dir_ios_parse(dev, show[DIR_FLASH])
+    define_pagg_parse(dev, show[SH_PAGG])
+    current_ios_parse(dev, show[SH_VER])
+    current_boot_parse(dev, show[SH_BOOT])
+    check_squeeze_parse(dev, show[DIR_ALL])
+
+    ports = uplink_ports(show[SH_UPLINK])
+    show_controllers = []
+    if ports:
+        commands = [f"sh controllers {port} | in vendor_name" for port in ports]
+        show_controller = send_batch(connection, commands)
+        show_controllers = [show_controller[cmd] for cmd in commands]
+    controller_parse(dev, ports, show_controllers)
+    return 2 if ports else 1, 6 + len(ports)
+
+
+def discovery_steps(dev, connection, settings):
+    start = time.monotonic()
+    if settings["batch"]:
+        dev.discovery_commands, dev.discovery_commands_legacy = discovery_batch(dev, connection)
+    else:
+        dir_ios(dev, connection)
+        ports = controller(dev, connection)
+        define_pagg(dev, connection)
+        current_ios(dev, connection)
+        current_boot(dev, connection)
+        check_squeeze(dev, connection)
+        dev.discovery_commands = dev.discovery_commands_legacy = 6 + len(ports)
+    dev.discovery_time = round(time.monotonic() - start, 2)
+    plan_images(dev, settings["image_policy"])
+    plan_squeeze(dev, settings)
+    dev.discovered = True
+
+
+def discovery(dev, connection, settings):
+    if settings["record"] and not step_done(dev, "discovery"):
+        # replan runs discovery of the corpus the same way as it was recorded
+        connection.record_discovery(settings["batch"])
+    run_step(dev, settings, "discovery", discovery_steps, dev, connection, settings)
+
+
+def window_closing(dev, settings, step):
+    # squeeze and copy take up to half an hour, they are not started close to the end of maintenance window.
+    # checked before each of them: a long squeeze may take the time the copy needed
+    if not settings["window"]:
+        return False
+    long_step = dev.squeeze_needed if step == "squeeze" else bool(dev.ios_copied)
+    left = settings["window"] - time.time()
+    if not long_step or step_done(dev, step) or left > settings["windowguard"] * 60:
+        return False
+    dev.deferred = f"{step} not started, maintenance window ends in {max(int(left / 60), 0)} min"
+    dev.logging.append(f"{dev.deferred}\n")
+    print(f"{dev.hostname:25}{dev.ip_address:17}{dev.deferred}, continue with resume")
+    return True
+
+
+def execute(dev, connection, settings):
+    run_step(dev, settings, "delete_ios", delete_ios, dev, connection, settings)
+    if window_closing(dev, settings, "squeeze"):
+        return
+    run_step(dev, settings, "squeeze", squeeze, dev, connection)
+    if window_closing(dev, settings, "copy"):
+        return
+    run_step(dev, settings, "copy", copy, dev, connection, settings)
+    if dev.requeue:
+        return
+    run_step(dev, settings, "check_md5", check_md5, dev, connection, settings)
+    run_step(dev, settings, "set_boot", set_boot, dev, connection)
+    share_image(dev, connection, settings)
+
+
+def needs_work(dev):
+    # devices without discovery data have to run the whole pipeline
+    if not dev.discovered:
+        return True
+    return bool(dev.ios_to_delete or dev.delete_files or dev.squeeze_needed or dev.ios_copied or dev.boot)
+
+
+def plan_fleet(devs, settings):
+    # one pass over the discovered fleet with the current image policy,
+    # prints changed plans and the fleet diff against current state
+    policy = settings["image_policy"]
+    changed = 0
+    groups = {}
+    transitions = {}
+    for dev in devs:
+        if not dev.discovered or dev.last_step not in (None, "discovery"):
+            continue
+        before = (dev.boot, dev.ios_copied, dev.ios_to_delete)
+        dev.boot, dev.ios_copied, dev.ios_to_delete, dev.md5 = "", "", [], None
+        dev.squeeze_needed, dev.squeeze_reason, dev.squeeze_saved = False, "", 0
+        plan_images(dev, policy)
+        plan_squeeze(dev, settings)
+        if (dev.boot, dev.ios_copied, dev.ios_to_delete) != before:
+            changed += 1
+            print(f"{dev.hostname:25}{dev.ip_address:17}plan changed by policy: "
+                  f"boot {ios_short(before[0])} -> {dev.boot_short}, copy {ios_short(before[1])} -> "
+                  f"{dev.ios_copied_short}, delete {[ios_short(i) for i in before[2]]} -> {dev.ios_to_delete_short}")
+
+        group = groups.setdefault(dev.policy_group, {"devices": 0, "up to date": 0, "copy": 0, "boot": 0, "delete": 0})
+        group["devices"] += 1
+        group["up to date"] += not (dev.boot or dev.ios_copied or dev.ios_to_delete)
+        group["copy"] += bool(dev.ios_copied)
+        group["boot"] += bool(dev.boot)
+        group["delete"] += bool(dev.ios_to_delete)
+        transition = (dev.current_ios_short, ios_short(policy["groups"][dev.policy_group]["primary"]))
+        transitions[transition] = transitions.get(transition, 0) + 1
+
+    print()
+    print("-------------------------------------------------------------------------------------------------------")
+    print(f"image policy: {policy['source']}  devices planned: {sum(g['devices'] for g in groups.values())}  "
+          f"plan changed: {changed}")
+    print("group               devices    up to date    copy       boot       delete")
+    for name, group in groups.items():
+        print(f"{name:20}{group['devices']:<11}{group['up to date']:<14}{group['copy']:<11}{group['boot']:<11}"
+              f"{group['delete']}")
+    print("current ios -> boot ios: devices")
+    for (current, target), number in sorted(transitions.items(), key=lambda item: -item[1]):
+        print(f"{str(current):20}-> {target:20}{number}")
+    print("-------------------------------------------------------------------------------------------------------")
+
+
+def print_result(dev):
+    print(f"{dev.hostname:25}{dev.ip_address:17}current ios:...................{dev.current_ios_short}\n"
+                                       f"{'':42}ios in flash:..................{dev.ios_list_short}\n"
+                                       f"{'':42}ios to delete:.................{dev.ios_to_delete_short}\n"
+                                       f"{'':42}ios copied:....................{dev.ios_copied_short}\n"
+                                       f"{'':42}boot current/new:..............{dev.current_boot_short}/{'didnt change' if dev.boot == '' else dev.boot_short}\n"
+                                       f"{'':42}md5 correct:...................{dev.md5_correct}\n"
+                                       f"{'':42}squeeze result:................{dev.squeeze_result}\n"
+                                       f"{'':42}squeeze plan:..................{dev.squeeze_reason}{f', saved ~{dev.squeeze_saved}s' if dev.squeeze_saved else ''}\n"
+                                       f"{'':42}all sfp cisco:.................{all(dev.sfp_vendor_cisco)}/{dev.sfp_vendor}\n"
+                                       f"{'':42}delete files:..................{dev.delete_files}\n"
+                                       f"{'':42}copy source / rate:............{dev.copy_source} / {dev.copy_rate} bytes/s\n"
+                                       f"{'':42}discovery:.....................{dev.discovery_commands} round trips "
+                                       f"(without batch {dev.discovery_commands_legacy}), {dev.discovery_time}s")
+
+
+def share_image(dev, connection, settings):
+    # verified seed serves the image to other devices behind the same PAGG over tftp
+    distributor = settings.get("distributor")
+    if not distributor or not distributor.is_seed(dev):
+        return
+    if dev.md5_correct and distributor.use_peers:
+        dev.logging.append(connection.send_config_set([f"tftp-server flash:{dev.ios_copied}"],
+                                                      strip_command=False, strip_prompt=False,
+                                                      read_timeout=20))
+        distributor.seed_done(dev, f"tftp://{dev.ip_address}/")
     else:
-        print(f"{dev.hostname:25}{dev.ip_address:17}current ios:...................{dev.current_ios_short}\n"
-                                           f"{'':42}ios in flash:..................{dev.ios_list_short}\n"
-                                           f"{'':42}ios to delete:.................{dev.ios_to_delete_short}\n"
-                                           f"{'':42}ios copied:....................{dev.ios_copied_short}\n"
-                                           f"{'':42}boot current/new:..............{dev.current_boot_short}/{'didnt change' if dev.boot == '' else dev.boot_short}\n"
-                                           f"{'':42}md5 correct:...................{dev.md5_correct}\n"
-                                           f"{'':42}squeeze result:................{dev.squeeze_result}\n"
-                                           f"{'':42}all sfp cisco:.................{all(dev.sfp_vendor_cisco)}/{dev.sfp_vendor}\n"
-                                           f"{'':42}delete files:..................{dev.delete_files}")       
+        distributor.seed_done(dev)
+
+
+def unshare_image(my_username, my_password, dev, settings):
+    try:
+        connection = open_session(my_username, my_password, dev, settings)
+        connection.send_config_set([f"no tftp-server flash:{dev.ios_copied}"], read_timeout=20)
+        close_session(dev, connection, settings)
+        print(f"{dev.hostname:25}{dev.ip_address:17}tftp-server flash:{dev.ios_copied_short} is removed")
+    except Exception as err_msg:
+        if settings.get("pool"):
+            settings["pool"].release(dev, healthy=False)
+        print(f"{dev.hostname:25}{dev.ip_address:17}[ERROR] tftp-server flash:{dev.ios_copied_short} "
+              f"is not removed: {err_msg}")
+
+
+def unshare_images(my_username, my_password, settings):
+    # all copies are done, seeds stop serving the image (tftp-server is not saved, reload removes it too)
+    distributor = settings.get("distributor")
+    if not distributor or not distributor.sharing:
+        return
+    seeds = distributor.sharing
+    distributor.sharing = []
+    print(f"\nremove tftp-server from {len(seeds)} seeds\n")
+    for start in range(0, len(seeds), settings["maxth"]):
+        threads = [Thread(target=unshare_image, args=(my_username, my_password, dev, settings))
+                   for dev in seeds[start:start + settings["maxth"]]]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+
+def del_squeeze_copy(dev, connection, settings):
+    discovery(dev, connection, settings)
+    if settings["cfg"]:
+        execute(dev, connection, settings)
+    if not dev.requeue:
+        print_result(dev)
+
+
+def discovery_only(dev, connection, settings):
+    discovery(dev, connection, settings)
+    print_result(dev)
+
+
+def execute_planned(dev, connection, settings):
+    discovery(dev, connection, settings)
+    execute(dev, connection, settings)
+    if not dev.requeue:
+        print_result(dev)
 
 
 #######################################################################################
 # ------------------------------ multithreading part ---------------------------------#
 #######################################################################################
 
-def connect_dev(my_username, my_password, dev_queue, settings):
+def classify_error(err_msg):
+    # netmiko raises its timeout exception for a refused connection too, socket error is chained to it
+    cause = err_msg
+    while cause is not None:
+        if isinstance(cause, ConnectionRefusedError):
+            return "refused"
+        cause = cause.__cause__ or cause.__context__
+    if isinstance(err_msg, NetmikoAuthenticationException):
+        return "auth"
+    if isinstance(err_msg, (NetmikoTimeoutException, TimeoutError)):
+        return "timeout"
+    return "other"
+
+
+def backoff_delay(settings, attempt):
+    # exponential backoff with jitter: half of the delay is fixed, half is random
+    delay = min(settings["backoff"] * 2 ** (attempt - 1), 300)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def open_session(my_username, my_password, dev, settings):
+    connect_handler = settings.get("connect_handler", ConnectHandler)
+
+    def login():
+        return connect_handler(device_type=dev.os_type, ip=dev.ip_address, username=my_username, password=my_password)
+
+    if settings.get("pool"):
+        ssh_conn = settings["pool"].acquire(dev, login)
+    else:
+        ssh_conn = login()
+    if settings["record"]:
+        ssh_conn = RecordingConnection(ssh_conn, settings["record"], dev.hostname, dev.ip_address)
+    return TimedConnection(ssh_conn, dev)
+
+
+def close_session(dev, ssh_conn, settings):
+    # in daemon mode the session goes back to the pool instead of disconnect
+    if settings.get("pool"):
+        if settings["record"]:
+            ssh_conn.connection.save()
+        settings["pool"].release(dev)
+    else:
+        ssh_conn.disconnect()
+
+
+def configures(pipeline, settings):
+    return settings["cfg"] and pipeline is not discovery_only
+
+
+def may_start(dev, settings, pipeline):
+    # new devices are not started when circuit breaker is open or maintenance window is over,
+    # they are left in the state store for resume. read-only discovery does not wait for the breaker
+    breaker = settings.get("breaker")
+    if breaker and breaker.open and configures(pipeline, settings):
+        dev.deferred = f"not started, circuit breaker is open: {breaker.reason}"
+    elif settings["window"] and time.time() >= settings["window"]:
+        dev.deferred = "not started, maintenance window is over"
+    else:
+        return True
+    print(f"{dev.hostname:25}{dev.ip_address:17}{dev.deferred}")
+    return False
+
+
+def connect_one(my_username, my_password, dev, settings, pipeline=del_squeeze_copy):
+    # returns True if the device has to be queued again (no free copy source)
+    if not may_start(dev, settings, pipeline):
+        return False
+    dev.requeue = False
+    distributor = settings.get("distributor")
+    if settings["cfg"] and distributor and copy_next(dev):
+        # copy source is taken before login, planned device is not connected to wait for it
+        dev.copy_slot = distributor.try_acquire(dev)
+        if dev.copy_slot is None:
+            dev.copy_slot = ""
+            return True
+    attempt = 1
+    session_start = time.monotonic()
     while True:
-        dev = dev_queue.get()
-        
-        attempts = 1
-        while True:
+        try:
+            if settings.get("login_limiter"):
+                wait_start = time.monotonic()
+                settings["login_limiter"].acquire(dev)
+                add_timing(dev, "login_wait", wait_start)
+            login_start = time.monotonic()
+            if settings.get("progress"):
+                settings["progress"].stage(dev, "login")
             try:
-                ssh_conn = ConnectHandler(device_type=dev.os_type, ip=dev.ip_address,
-                                          username=my_username, password=my_password)
-                del_squeeze_copy(dev, ssh_conn, settings)
-                ssh_conn.disconnect()
-                dev_queue.task_done()
-                break
-            except Exception as err_msg:
-                if attempts == 0:
-                    dev.connection_status = False
-                    dev.connection_error_msg = str(err_msg)
-                    print(f"{dev.hostname:25}{dev.ip_address:17}connection failed after all attempts, {err_msg}")
+                ssh_conn = open_session(my_username, my_password, dev, settings)
+            finally:
+                add_timing(dev, "login", login_start)
+            pipeline(dev, ssh_conn, settings)
+            if dev.copy_slot:
+                # copy was not started: window closing, no free space, uplink sfp
+                distributor.release(dev, dev.copy_slot)
+                dev.copy_slot = ""
+            add_timing(dev, "total", session_start)
+            close_session(dev, ssh_conn, settings)
+            if dev.requeue:
+                return True
+            if not (pipeline is discovery_only and settings["cfg"] and needs_work(dev)):
+                # otherwise the device is finished in phase two
+                finish_device(dev, settings, configures(pipeline, settings))
+            elif settings.get("progress"):
+                settings["progress"].stage(dev, "planned")
+            break
+        except Exception as err_msg:
+            error_type = classify_error(err_msg)
+            if dev.copy_slot:
+                # source is taken again after the login
+                distributor.release(dev, dev.copy_slot)
+                dev.copy_slot = ""
+            if settings.get("pool"):
+                # session may be broken in the middle of a command, it is not reused
+                settings["pool"].release(dev, healthy=False)
+            # wrong password will not be fixed by retry, it only locks the account on AAA
+            if attempt >= settings["attempts"] or error_type == "auth":
+                dev.connection_status = False
+                dev.connection_error_msg = str(err_msg)
+                dev.connection_error_type = error_type
+                save_state(dev, settings)
+                if settings.get("distributor"):
+                    settings["distributor"].seed_done(dev)
+                add_timing(dev, "total", session_start)
+                print(f"{dev.hostname:25}{dev.ip_address:17}connection failed after {attempt} attempts "
+                      f"({error_type}), {err_msg}")
+                if not settings.get("pool"):
                     try:
                         ssh_conn.disconnect()
                     except:
                         pass
-                    dev_queue.task_done()
-                    break
-                else:
-                    attempts -= 1
-                    print(f"{dev.hostname:25}{dev.ip_address:17}connection failed: {err_msg}")
-                    time.sleep(5)
+                finish_device(dev, settings, configures(pipeline, settings))
+                break
+            else:
+                delay = backoff_delay(settings, attempt)
+                attempt += 1
+                print(f"{dev.hostname:25}{dev.ip_address:17}connection failed ({error_type}): {err_msg}, "
+                      f"retry in {delay:.1f}s")
+                time.sleep(delay)
+
+
+def connect_dev(my_username, my_password, dev_queue, settings, pipeline=del_squeeze_copy):
+    while True:
+        dev = dev_queue.get()
+        if dev is None:
+            # all devices are done, thread is not needed anymore (daemon runs many jobs)
+            break
+        if connect_one(my_username, my_password, dev, settings, pipeline):
+            # without a short wait the queue would spin when only waiting devices are left
+            settings["distributor"].wait(COPY_SLOT_WAIT)
+            if settings.get("progress"):
+                settings["progress"].stage(dev, "queued")
+            dev_queue.put(dev)
+        dev_queue.task_done()
 
 
 def connect(my_username, my_password, dev_queue, settings):
@@ -512,46 +2075,465 @@ def connect(my_username, my_password, dev_queue, settings):
     del_squeeze_copy(dev, ssh_conn, settings)
     ssh_conn.disconnect()
     dev_queue.task_done()
-    
+
+
+def run_threads(my_username, my_password, devs, settings, maxth, pipeline=del_squeeze_copy):
+    if settings.get("progress"):
+        settings["progress"].threads(maxth)
+    dev_queue = queue.Queue()
+
+    for flow in range(maxth):
+        #th = Thread(target=connect, args=(my_username, my_password, dev_queue, settings))
+        th = Thread(target=connect_dev, args=(my_username, my_password, dev_queue, settings, pipeline))
+        th.daemon = True
+        th.start()
+
+    for dev in devs:
+        dev_queue.put(dev)
+
+    dev_queue.join()
+    for flow in range(maxth):
+        dev_queue.put(None)
+
+
+#######################################################################################
+# ------------------------------ run part --------------------------------------------#
+#######################################################################################
+
+def prepare(settings, log_folder):
+    if not settings["runtime"]:
+        # HH.MM.SS prefix of all files of the run: logs, results, status, plan, metrics
+        settings["runtime"] = datetime.now().strftime("%H.%M.%S")
+    if settings["worker"]:
+        # records get the worker's stderr to themselves, prints and tracebacks go to stdout
+        settings["record_channel"] = os.fdopen(os.dup(2), "w")
+        os.dup2(1, 2)
+    settings["login_limiter"] = LoginLimiter(settings["loginrate"], settings["regionrate"])
+    if settings["replay"]:
+        settings["connect_handler"] = ReplayHandler(settings["replay"]).ConnectHandler
+    if settings["engine"] == "async" and "connect_handler" not in settings:
+        # ssh sessions of the run are held by one asyncio event loop, closed in run_devices
+        settings["transport"] = AsyncTransport()
+        settings["connect_handler"] = settings["transport"].ConnectHandler
+    settings["store"] = StateStore(settings["state"])
+    # worker sends its devices to the coordinator, log files are written there
+    settings["logwriter"] = None if settings["worker"] else LogWriter(log_folder, settings)
+    settings["metrics"] = Metrics()
+    # coordinator does not see devices in flight, every worker writes its own status file
+    settings["progress"] = Progress(log_folder, settings) if settings["status"] and not settings["workers"] else None
+    settings["breaker"] = CircuitBreaker(settings["maxerr"]) if settings["maxerr"] is not None else None
+    srclimit, pagglimit = settings["srclimit"], settings["pagglimit"]
+    if settings["shard"] is not None:
+        # every worker has its own distributor, limits of the run are split between workers
+        total = settings["shard"][1]
+        srclimit = srclimit and max(1, srclimit // total)
+        pagglimit = pagglimit and max(1, pagglimit // total)
+    settings["distributor"] = Distributor(settings["ftp"], settings["mirrors"], srclimit,
+                                          settings["seeds"], settings["peers"], pagglimit)
+
+
+def run(my_username, my_password, devs, settings, log_folder, current_time):
+    progress = settings.get("progress")
+    if settings["twophase"] or settings["plan"]:
+        if not settings["plan"]:
+            # phase one: read-only discovery of the whole fleet
+            devs_discovery = [dev for dev in devs if not dev.discovered]
+            if progress:
+                progress.add(devs_discovery)
+            run_threads(my_username, my_password, devs_discovery, settings, settings["discth"], discovery_only)
+        # plan file may be made with another policy, whole fleet is planned again in one pass
+        plan_fleet(devs, settings)
+        if not settings["plan"]:
+            # workers have the time of the coordinator, every worker writes the plan of its shard
+            shard = "" if settings["shard"] is None else f"_shard{settings['shard'][0]}"
+            plan_file = log_folder / f"{current_time}_plan{shard}.json"
+            write_plan(devs, plan_file)
+            print(f"\nplan is saved: {plan_file}")
+        if settings["cfg"]:
+            # phase two: only devices which have something to delete, squeeze, copy or re-boot
+            devs_todo = [dev for dev in devs if dev.connection_status and needs_work(dev)]
+            print(f"\ndevices to configure: {len(devs_todo)} of {len(devs)}\n")
+            if progress:
+                progress.add(devs_todo)
+            if settings["waves"]:
+                run_waves(my_username, my_password, devs_todo, settings, execute_planned)
+            else:
+                run_threads(my_username, my_password, interleave(devs_todo), settings, settings["maxth"], execute_planned)
+    else:
+        if progress:
+            progress.add(devs)
+        if settings["waves"]:
+            run_waves(my_username, my_password, devs, settings)
+        else:
+            run_threads(my_username, my_password, interleave(devs), settings, settings["maxth"])
+    unshare_images(my_username, my_password, settings)
+
+
+def run_waves(my_username, my_password, devs, settings, pipeline=del_squeeze_copy):
+    # devices go in waves inside one region or PAGG. first wave of every region or PAGG is wavesize devices,
+    # wave size and threads are doubled after every wave with error rate under maxerr, otherwise the run stops
+    # (continue with resume)
+    groups = {}
+    for dev in devs:
+        key = dev.hostname.split("-")[0]
+        if settings["waves"] == "pagg" and dev.pagg:
+            key = dev.pagg
+        groups.setdefault(key, []).append(dev)
+
+    breaker = settings["breaker"]
+    number = 0
+    started = 0
+    for key, group in groups.items():
+        size = settings["wavesize"]
+        position = 0
+        while position < len(group):
+            wave = group[position:position + size]
+            position += len(wave)
+            number += 1
+            threads = min(settings["maxth"], size, len(wave))
+            print(f"\nwave {number}: {key}, {len(wave)} devices, {threads} threads\n")
+            breaker.new_wave()
+            run_threads(my_username, my_password, interleave(wave), settings, threads, pipeline)
+            started += len(wave)
+            if not breaker.end_wave():
+                for dev in [dev for group in groups.values() for dev in group][started:]:
+                    dev.deferred = f"not started, circuit breaker is open: {breaker.reason}"
+                print(f"\ncircuit breaker is open after wave {number}: {breaker.reason}\n"
+                      f"{len(devs) - started} devices are not started, they stay in the state store, "
+                      f"run again with resume\n")
+                return
+            size *= 2
+
+
+def run_devices(my_username, my_password, devices, settings, log_folder, start_time):
+    total_devices = len(devices)
+
+    prepare(settings, log_folder)
+    current_time = settings["runtime"]
+    if settings["resume"]:
+        devices = resume_devices(devices, settings["store"], settings)
+    else:
+        settings["store"].reset(devices)
+    skipped_devices = total_devices - len(devices)
+
+    if settings["progress"]:
+        print(f"\nstatus file: {settings['progress'].status_file}")
+    print()
+    print("-------------------------------------------------------------------------------------------------------")
+    print("hostname                 ip address       comment")
+    print("-------------------------------------------------------------------------------------------------------")
+
+    run(my_username, my_password, devices, settings, log_folder, current_time)
+    if settings.get("transport"):
+        settings["transport"].close()
+    if settings["progress"]:
+        settings["progress"].close()
+
+    if settings["worker"]:
+        # log files and metrics are written by the coordinator
+        failed_connection_count = len([dev for dev in devices if not dev.connection_status])
+        errors_count = len([dev for dev in devices if dev.error])
+        metrics_summary = settings["metrics"].summary()
+    else:
+        failed_connection_count, errors_count = settings["logwriter"].close()
+        metrics_summary = settings["metrics"].write(log_folder / f"{current_time}_metrics.json", settings["prom"])
+    settings["store"].close()
+    duration = datetime.now() - start_time
+
+    print_summary(devices, total_devices, skipped_devices, settings, failed_connection_count, errors_count,
+                  metrics_summary, duration)
+
+
+def replan(corpus, settings):
+    # discovery and planning from recorded corpus, no ssh
+    devs = []
+    for record in load_corpus(corpus):
+        dev = CellSiteGateway(ip=record["ip"], host=record["hostname"])
+        try:
+            discovery_steps(dev, ReplayConnection(record), dict(settings, batch=record["batch"]))
+        except Exception as err_msg:
+            dev.connection_status = False
+            dev.connection_error_msg = f"replay failed: {err_msg}"
+            print(f"{dev.hostname:25}{dev.ip_address:17}replay failed: {err_msg}")
+        else:
+            print_result(dev)
+        devs.append(dev)
+    return devs
+
+
+def simulated_inventory(settings):
+    # same seed in every process, so all workers see the same simulated inventory
+    farm = SimulatedFarm(scale=settings["simscale"])
+    settings["connect_handler"] = farm.ConnectHandler
+    return farm.generate(settings["sim"]).items()
+
+
+def simulated_devices(settings):
+    inventory = select_inventory(simulated_inventory(settings), settings)
+    return [CellSiteGateway(ip=ip_address, host=hostname) for hostname, ip_address in inventory]
+
+
+def worker_command(arguments, settings, index):
+    arguments = [arg for arg in arguments[1:]
+                 if not arg.startswith(("workers=", "hosts=", "remotedir=", "runtime="))]
+    arguments += ["worker", f"shard={index}/{settings['workers']}", f"runtime={settings['runtime']}"]
+    if not settings["hosts"]:
+        return [sys.executable, "-u", os.path.abspath(__file__)] + arguments
+    host = settings["hosts"][index % len(settings["hosts"])]
+    remotedir = settings["remotedir"] or os.getcwd()
+    command = f"cd {shlex.quote(remotedir)} && python3 -u main.py {' '.join(shlex.quote(arg) for arg in arguments)}"
+    return ["ssh", host, command]
+
+
+def print_worker(process):
+    for line in process.stdout:
+        print(line, end="")
+
+
+def read_worker(process, settings, records):
+    printer = Thread(target=print_worker, args=(process,))
+    printer.start()
+    for line in process.stderr:
+        if line.startswith(RECORD_PREFIX):
+            record = json.loads(line[len(RECORD_PREFIX):])
+            settings["logwriter"].write(record)
+            settings["metrics"].add(record)
+            settings["store"].md5_count(record["md5_cache"])
+            # coordinator keeps only the device state of the record
+            record["logging"] = ""
+            record["commands"] = []
+            records.append(record)
+        else:
+            print(line, end="")
+    printer.join()
+    process.wait()
+
+
+def coordinate(arguments, settings):
+    # splits devices between workers (local processes or ssh to hosts), collects devices they finished
+    records = []
+    processes = []
+    readers = []
+    for index in range(settings["workers"]):
+        process = subprocess.Popen(worker_command(arguments, settings, index), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True, bufsize=1)
+        reader = Thread(target=read_worker, args=(process, settings, records))
+        reader.start()
+        processes.append(process)
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+    for index, process in enumerate(processes):
+        if process.returncode:
+            print(f"worker {index} failed, return code: {process.returncode}")
+    return [dev_from_dict(record) for record in records]
+
+
+class JobOutput:
+    # stdout of a daemon job goes to the client, the job goes on if the client is gone
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except OSError:
+            pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def evict_sessions(pool):
+    while True:
+        time.sleep(max(1, pool.idle / 10))
+        pool.evict()
+
+
+def run_job(my_username, my_password, inventory, arguments, daemon_settings):
+    start_time = datetime.now()
+    log_folder = Path(f"{Path.cwd()}/logs/{start_time.strftime('%Y.%m.%d')}/")
+    log_folder.mkdir(parents=True, exist_ok=True)
+    settings = get_argv(arguments)
+    if settings["workers"] or settings["replan"] or settings["replay"] or settings["daemon"]:
+        print("\nworkers, replan, replay and daemon are not supported in daemon job\n")
+        return
+    daemon_settings["jobs"] += 1
+    if not settings["runtime"]:
+        # jobs started in the same second must not write to the same files
+        settings["runtime"] = f"{start_time.strftime('%H.%M.%S')}_job{daemon_settings['jobs']}"
+    settings["pool"] = daemon_settings["pool"]
+    settings["engine"] = daemon_settings["engine"]  # pooled sessions belong to the transport of the daemon
+    if "connect_handler" in daemon_settings:
+        settings["connect_handler"] = daemon_settings["connect_handler"]
+    if settings["plan"]:
+        devices = load_plan(settings["plan"], settings)
+    else:
+        devices = [CellSiteGateway(ip=ip_address, host=hostname)
+                   for hostname, ip_address in select_inventory(inventory, settings)]
+    run_devices(my_username, my_password, devices, settings, log_folder, start_time)
+
+
+def daemon(settings):
+    # jobs from unix socket (python main.py job ...) run one by one in this process,
+    # psw.yaml and devices.yaml are read once, ssh sessions stay open in the pool between jobs
+    if settings["sim"]:
+        username, password = "sim", "sim"
+        inventory = list(simulated_inventory(settings))
+    else:
+        username, password = get_user_pw()
+        inventory = list(iter_inventory("devices.yaml"))
+    if settings["engine"] == "async" and not settings["sim"]:
+        # sessions of the pool stay in the event loop between jobs
+        settings["connect_handler"] = AsyncTransport().ConnectHandler
+    settings["pool"] = SessionPool(settings["poolsize"], settings["idle"])
+    settings["jobs"] = 0  # job number is in the file prefix of the job
+    Thread(target=evict_sessions, args=(settings["pool"],), daemon=True).start()
+
+    socket_file = Path(settings["socket"])
+    socket_file.parent.mkdir(parents=True, exist_ok=True)
+    socket_file.unlink(missing_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_file))
+    server.listen()
+    print(f"\ndaemon is ready: {socket_file}, devices: {len(inventory)}\n")
+    try:
+        while True:
+            client, _ = server.accept()
+            with client, client.makefile("rw") as stream:
+                arguments = json.loads(stream.readline())
+                print(f"{datetime.now()} job: {' '.join(arguments)}")
+                if arguments == ["stop"]:
+                    stream.write("daemon is stopped\n")
+                    break
+                if arguments == ["status"]:
+                    stream.write(f"devices: {len(inventory)}, ssh sessions: {settings['pool'].stats()}\n")
+                    continue
+                with redirect_stdout(JobOutput(stream)):
+                    try:
+                        run_job(username, password, inventory, arguments, settings)
+                    except Exception as err_msg:
+                        print(f"job failed: {err_msg}")
+    finally:
+        server.close()
+        socket_file.unlink(missing_ok=True)
+        settings["pool"].close_all()
+
+
+def send_job(arguments):
+    # python main.py job [socket=path] <main.py arguments> | status | stop
+    socket_file = "logs/daemon.sock"
+    job = []
+    for arg in arguments:
+        if arg.startswith("socket="):
+            socket_file = arg.split("=", 1)[1]
+        elif arg != "job":
+            job.append(arg)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_file)
+    with client, client.makefile("rw") as stream:
+        stream.write(json.dumps(job) + "\n")
+        stream.flush()
+        for line in stream:
+            print(line, end="")
+
+
+def print_summary(devs, total_devices, skipped_devices, settings, failed_connection_count, errors_count,
+                  metrics_summary, duration):
+    store = settings["store"]
+    print()
+    print("-------------------------------------------------------------------------------------------------------")
+    print(f"total device number: {total_devices}")
+    if settings["resume"]:
+        print(f"skipped (finished in previous run): {skipped_devices}")
+    print(f"md5 cache hit/miss: {store.md5_hits}/{store.md5_misses}")
+    discovered = [dev for dev in devs if dev.discovery_commands]
+    if discovered:
+        print(f"discovery round trips: {sum(dev.discovery_commands for dev in discovered)} "
+              f"(without batch {sum(dev.discovery_commands_legacy for dev in discovered)})  "
+              f"avg time: {sum(dev.discovery_time for dev in discovered) / len(discovered):.2f}s")
+    print(f"squeeze skipped: {sum(1 for dev in devs if dev.squeeze_saved)}  "
+          f"predicted time saved: {sum(dev.squeeze_saved for dev in devs)}s")
+    print(f"failed connection: {failed_connection_count}  errors: {errors_count}")
+    deferred = [dev for dev in devs if dev.deferred]
+    if deferred:
+        print(f"deferred (continue with resume): {len(deferred)}")
+    if settings.get("breaker") and settings["breaker"].open:
+        print(f"circuit breaker is open: {settings['breaker'].reason}")
+    if settings.get("pool"):
+        print(f"daemon ssh sessions: {settings['pool'].stats()}")
+    error_types = {}
+    for dev in devs:
+        if not dev.connection_status:
+            error_types[dev.connection_error_type] = error_types.get(dev.connection_error_type, 0) + 1
+    if error_types:
+        print(f"failed connection by type: {error_types}")
+    print(f"elapsed time: {duration}")
+    print(f"throughput: {metrics_summary['devices_per_hour']} devices/hour")
+    for step, step_metrics in metrics_summary["steps"].items():
+        print(f"{step:15}p50: {step_metrics['p50']:<10}p95: {step_metrics['p95']:<10}max: {step_metrics['max']}")
+    if metrics_summary["copy_rate"]:
+        print(f"copy rate bytes/s: p50: {metrics_summary['copy_rate']['p50']}  min: {metrics_summary['copy_rate']['min']}")
+    print("-------------------------------------------------------------------------------------------------------\n")
+
 
 #######################################################################################
 # ------------------------------ main part -------------------------------------------#
 #######################################################################################
 
-start_time = datetime.now()
-current_date = start_time.strftime("%Y.%m.%d")
-current_time = start_time.strftime("%H.%M")
-log_folder = Path(f"{Path.cwd()}/logs/{current_date}/")  # current dir / logs / date /
-log_folder.mkdir(exist_ok=True)
-
-argv_dict = get_argv(argv)
-username, password = get_user_pw()
-devices = get_devinfo()
-total_devices = len(devices)
-q = queue.Queue()
-
-print()
-print("-------------------------------------------------------------------------------------------------------")
-print("hostname                 ip address       comment")
-print("-------------------------------------------------------------------------------------------------------")
-
-for flow in range(argv_dict["maxth"]):
-    #th = Thread(target=connect, args=(username, password, q, argv_dict))
-    th = Thread(target=connect_dev, args=(username, password, q, argv_dict))
-    th.daemon = True
-    th.start()
-
-for device in devices:
-    q.put(device)
-
-q.join()
-
-failed_connection_count, errors_count = write_logs(devices, log_folder, argv_dict)
-duration = datetime.now() - start_time
-
-print()
-print("-------------------------------------------------------------------------------------------------------")
-print(f"total device number: {total_devices}")
-print(f"failed connection: {failed_connection_count}  errors: {errors_count}")
-print(f"elapsed time: {duration}")
-print("-------------------------------------------------------------------------------------------------------\n")
+def main():
+    if "job" in argv[1:]:
+        send_job(argv[1:])
+        return
+
+    start_time = datetime.now()
+    current_date = start_time.strftime("%Y.%m.%d")
+    log_folder = Path(f"{Path.cwd()}/logs/{current_date}/")  # current dir / logs / date /
+    log_folder.mkdir(exist_ok=True)
+
+    argv_dict = get_argv(argv)
+    if not argv_dict["runtime"]:
+        # workers get the time of the coordinator, all files of the run have the same prefix
+        argv_dict["runtime"] = start_time.strftime("%H.%M.%S")
+    current_time = argv_dict["runtime"]
+    if argv_dict["replan"]:
+        devices = replan(argv_dict["replan"], argv_dict)
+        plan_fleet(devices, argv_dict)
+        plan_file = log_folder / f"{current_time}_plan.json"
+        write_plan(devices, plan_file)
+        print(f"\nplan is saved: {plan_file}")
+        print(f"devices to configure: {len([dev for dev in devices if dev.connection_status and needs_work(dev)])} "
+              f"of {len(devices)}, elapsed time: {datetime.now() - start_time}\n")
+        return
+
+    if argv_dict["workers"]:
+        prepare(argv_dict, log_folder)
+        print()
+        devices = coordinate(argv, argv_dict)
+        failed_connection_count, errors_count = argv_dict["logwriter"].close()
+        metrics_summary = argv_dict["metrics"].write(log_folder / f"{current_time}_metrics.json", argv_dict["prom"])
+        argv_dict["store"].close()
+        print_summary(devices, len(devices), 0, argv_dict, failed_connection_count, errors_count,
+                      metrics_summary, datetime.now() - start_time)
+        return
+
+    if argv_dict["daemon"]:
+        daemon(argv_dict)
+        return
+
+    if argv_dict["sim"]:
+        username, password = "sim", "sim"
+        devices = simulated_devices(argv_dict)
+    else:
+        username, password = get_user_pw()
+        devices = None if argv_dict["plan"] else get_devinfo(argv_dict)
+    if argv_dict["plan"]:
+        devices = load_plan(argv_dict["plan"], argv_dict)
+    run_devices(username, password, devices, argv_dict, log_folder, start_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import random
+import re
+import time
+from threading import Lock
+
+from netmiko.exceptions import NetmikoAuthenticationException, NetmikoTimeoutException
+
+
+#######################################################################################
+# ------------------------------ simulated ASR901 ------------------------------------#
+#######################################################################################
+
+# image: (size, md5)
+IMAGES = {"asr901-universalk9-mz.156-2.SP9.bin": (40187848, "d2864fe9a1725cde1d12d7e237b6be2f"),
+          "asr901-universalk9-mz.155-3.S10.bin": (38541196, "87d293427559873cb5e7f36ec1599733"),
+          "asr901-universalk9-mz.154-3.S4.bin": (35119228, "3f1a7a0f6f3ad4c1b7a9e2b0a1d2c3e4"),
+          "asr901-universalk9-mz.153-3.S5.bin": (33852712, "9c0e5b4a2d1f3e6a7b8c9d0e1f2a3b4c")}
+FLASH_TOTAL = 129996800
+PAGGS = ("alma-003001-pagg-1", "alma-010001-pagg-1", "alma-011001-pagg-1",
+         "asta-032001-pagg-1", "asta-041001-pagg-1", "shym-001001-pagg-1")
+DATE = "Feb 27 2023 10:11:12 +06:00"
+
+
+def image_to_version(image):
+    # asr901-universalk9-mz.156-2.SP9.bin -> 15.6(2)SP9
+    short = re.search(r"mz.(\S+).bin", image)[1]
+    train, rest = short.split("-")
+    release, name = rest.split(".", 1)
+    return f"{train[:2]}.{train[2:]}({release}){name}"
+
+
+class SimulatedASR901:
+    # answers netmiko calls with ASR901 style output, keeps flash and boot state between sessions
+
+    def __init__(self, farm, hostname, ip, rnd):
+        self.farm = farm
+        self.hostname = hostname
+        self.ip = ip
+        self.base_prompt = hostname
+        self.pagg = rnd.choice(PAGGS)
+        self.uplinks = [f"Gi0/{10 + i}" for i in range(rnd.choice((1, 2)))]
+        self.vendors = ["CISCO-FINISAR" if rnd.random() > farm.non_cisco_sfp else "OEM"
+                        for _ in self.uplinks]
+        running = rnd.choice(list(IMAGES))
+        self.running = running
+        self.boot = running
+        self.files = {}  # name: (size, md5)
+        for image in rnd.sample(list(IMAGES), rnd.choice((1, 2, 3))) + [running]:
+            self.files[image] = IMAGES[image]
+        self.files["vlan.dat"] = (1024, "")
+        if rnd.random() < 0.3:
+            self.files["crashinfo_20230101"] = (204800, "")
+        self.deleted = {}
+        if rnd.random() < 0.3:
+            self.deleted["old_core.bin"] = (rnd.randint(1, 20) * 1000000, "")
+        self.pending = None  # interactive command waiting for an answer
+        self.transfer = None  # copy in progress, output is read with read_channel
+        self.copy_args = None  # (source, name) of copy waiting for destination filename
+        self.channel = ""
+        self.config = []
+        self.tftp_files = set()  # files served by tftp-server
+
+    def free(self):
+        used = sum(size for size, md5 in self.files.values()) + sum(size for size, md5 in self.deleted.values())
+        return FLASH_TOTAL - used
+
+    def dir_line(self, number, name, size, deleted=False):
+        name = f"[{name}]" if deleted else name
+        return f"{number:>5}  -rw-  {size:>10}  {DATE}  {name}"
+
+    def dir_flash(self, only=None, deleted=False):
+        lines = ["Directory of flash:/", ""]
+        for number, (name, (size, md5)) in enumerate(self.files.items(), start=2):
+            if only is None or only == name:
+                lines.append(self.dir_line(number, name, size))
+        if deleted:
+            for number, (name, (size, md5)) in enumerate(self.deleted.items(), start=100):
+                lines.append(self.dir_line(number, name, size, deleted=True))
+        lines += ["", f"{FLASH_TOTAL} bytes total ({self.free()} bytes free)"]
+        return "\n".join(lines)
+
+    def answer(self, command):
+        # interactive prompts first
+        if self.pending:
+            pending, self.pending = self.pending, None
+            return pending(command)
+
+        if command == "dir flash:":
+            return self.dir_flash()
+        if command == "dir flash: | in free":
+            return f"{FLASH_TOTAL} bytes total ({self.free()} bytes free)"
+        if command == "dir /a":
+            return self.dir_flash(deleted=True)
+        if command.startswith("dir flash:"):
+            return self.dir_flash(only=command[len("dir flash:"):])
+        if command.startswith("sh int descr"):
+            lines = ["Interface                      Status         Protocol Description"]
+            lines += [f"{port:31}up             up       UPLINK to {self.pagg}" for port in self.uplinks]
+            return "\n".join(lines)
+        if command.startswith("sh controllers"):
+            port = command.split()[2]
+            if port in self.uplinks:
+                return f"  vendor_name                  : {self.vendors[self.uplinks.index(port)]}"
+            return ""
+        if command.startswith("sh isis hostname"):
+            return f"  2     1921.6800.1001 {self.pagg}"
+        if command.startswith("sh ver"):
+            return (f"Cisco IOS Software, 901 Software (ASR901-UNIVERSALK9-M), "
+                    f"Version {image_to_version(self.running)}, RELEASE SOFTWARE (fc2)")
+        if command.startswith("sh run | in boot system flash"):
+            return f"boot system flash {self.boot}" if self.boot else ""
+        if command.startswith("delete /force flash:"):
+            return self.delete(command[len("delete /force flash:"):])
+        if command.startswith("delete flash:"):
+            name = command[len("delete flash:"):]
+            self.pending = lambda answer: self.delete_confirm(name)
+            return f"Delete filename [{name}]?"
+        if command == "squeeze flash:":
+            self.pending = lambda answer: self.squeeze()
+            return "All deleted files will be removed. Continue? [confirm]"
+        if command.startswith("copy "):
+            source = command.split()[1]
+            name = source.rsplit("/", 1)[-1]
+            self.pending = lambda answer: self.copy(source, name)
+            self.copy_args = (source, name)
+            return f"Destination filename [{name}]?"
+        if command.startswith("verify /md5"):
+            name = command.split()[-1].replace("flash:", "")
+            self.farm.sleep(self.farm.md5_time)
+            if name not in self.files:
+                return f"%Error verifying flash:{name} (No such file or directory)"
+            return f"{'.' * 20}Done!\nverify /md5 (flash:{name}) = {self.files[name][1]}"
+        if command.startswith("!") or command == "":
+            return ""
+        return "% Invalid input detected at '^' marker."
+
+    def delete(self, name):
+        if name in self.files:
+            self.deleted[name] = self.files.pop(name)
+            return ""
+        return f"%Error deleting flash:{name} (No such file or directory)"
+
+    def delete_confirm(self, name):
+        self.pending = lambda answer: self.delete(name)
+        return f"Delete flash:/{name}? [confirm]"
+
+    def squeeze(self):
+        self.farm.sleep(self.farm.squeeze_time)
+        self.deleted = {}
+        return "Squeeze of flash complete"
+
+    def copy(self, source, name):
+        self.copy_args = None
+        if name not in IMAGES:
+            return f"%Error opening {source} (No such file or directory)"
+        size, md5 = IMAGES[name]
+        if size > self.free():
+            return f"%Error copying {source} (Not enough space on device)"
+        self.farm.sleep(self.farm.copy_time)
+        if self.farm.rnd.random() < self.farm.md5_fail:
+            md5 = "0" * 32
+        self.files[name] = (size, md5)
+        seconds = self.farm.copy_time
+        return (f"Accessing {source}...\nLoading {name} {'!' * 40}\n[OK - {size}/4096 bytes]\n\n"
+                f"{size} bytes copied in {seconds:.3f} secs ({int(size / seconds) if seconds else size} bytes/sec)")
+
+    def start_copy(self, source, name):
+        if name not in IMAGES or IMAGES[name][0] > self.free():
+            self.channel += self.copy(source, name) + f"\n{self.hostname}#"
+            return
+        size, md5 = IMAGES[name]
+        if self.farm.rnd.random() < self.farm.md5_fail:
+            md5 = "0" * 32
+        stall = self.farm.rnd.random() < self.farm.copy_stall
+        self.transfer = {"source": source, "name": name, "size": size, "md5": md5, "stall": stall,
+                         "start": time.monotonic(), "bangs": 0}
+        self.channel += f"Accessing {source}...\nLoading {name} "
+
+    def read_transfer(self):
+        # "!" every 4096 bytes, stalled transfer stops at 30%
+        transfer = self.transfer
+        duration = self.farm.copy_time * self.farm.scale
+        done = min((time.monotonic() - transfer["start"]) / duration, 1) if duration else 1
+        if transfer["stall"]:
+            done = min(done, 0.3)
+        bangs = int(transfer["size"] * done / 4096)
+        output = "!" * (bangs - transfer["bangs"])
+        transfer["bangs"] = bangs
+        if done == 1:
+            self.files[transfer["name"]] = (transfer["size"], transfer["md5"])
+            seconds = max(duration, 0.001)
+            output += (f"\n[OK - {transfer['size']}/4096 bytes]\n\n{transfer['size']} bytes copied in "
+                       f"{seconds:.3f} secs ({int(transfer['size'] / seconds)} bytes/sec)\n{self.hostname}#")
+            self.transfer = None
+        return output
+
+    def abort_transfer(self):
+        self.channel += f"\n%Error reading {self.transfer['source']} (I/O error)\n{self.hostname}#"
+        self.transfer = None
+
+    def configure(self, line):
+        if line == "no boot system":
+            self.boot = ""
+        elif line.startswith("boot system flash "):
+            self.boot = line.split()[-1]
+        elif line.startswith("tftp-server flash:"):
+            self.tftp_files.add(line.split(":", 1)[1])
+        elif line.startswith("no tftp-server flash:"):
+            self.tftp_files.discard(line.split(":", 1)[1])
+        self.config.append(line)
+
+
+class SimulatedSession:
+    # stands for netmiko.ConnectHandler object
+
+    def __init__(self, farm, device):
+        self.farm = farm
+        self.device = device
+        self.base_prompt = device.hostname
+        self.alive = True
+
+    def send_command(self, command_string, expect_string=None, read_timeout=10, strip_command=True,
+                     strip_prompt=True, **kwargs):
+        self.farm.sleep(self.farm.latency)
+        output = self.device.answer(command_string)
+        if not strip_command:
+            output = f"{command_string}\n{output}"
+        if not strip_prompt:
+            output = f"{output}\n{self.base_prompt}#"
+        return output
+
+    def send_config_set(self, config_commands, **kwargs):
+        self.farm.sleep(self.farm.latency)
+        for line in config_commands:
+            self.device.configure(line)
+        lines = [f"{self.base_prompt}(config)#{line}" for line in config_commands]
+        return "\n".join(["configure terminal"] + lines + ["end", f"{self.base_prompt}#"])
+
+    def save_config(self, *args, **kwargs):
+        self.farm.sleep(self.farm.latency)
+        return "write mem\nBuilding configuration...\n[OK]"
+
+    def write_channel(self, out_data):
+        if out_data == "\x1e" and self.device.transfer:
+            self.device.abort_transfer()
+            return
+        if out_data == "\n" and self.device.pending and self.device.copy_args:
+            # copy confirmed from write_channel, output is streamed to read_channel
+            source, name = self.device.copy_args
+            self.device.pending = None
+            self.device.copy_args = None
+            self.device.start_copy(source, name)
+            return
+        lines = out_data.split("\n")[:-1]
+        output = []
+        for number, line in enumerate(lines):
+            echo = line if number == 0 else f"{self.base_prompt}#{line}"
+            output += [echo, self.device.answer(line)]
+        output.append(f"{self.base_prompt}#")
+        self.device.channel += "\n".join(output)
+
+    def read_until_pattern(self, pattern="", read_timeout=10, **kwargs):
+        self.farm.sleep(self.farm.latency)
+        output, self.device.channel = self.device.channel, ""
+        return output
+
+    def read_channel(self):
+        output, self.device.channel = self.device.channel, ""
+        if self.device.transfer:
+            output += self.device.read_transfer()
+        return output
+
+    def is_alive(self):
+        return self.alive
+
+    def disconnect(self):
+        if self.alive:
+            self.alive = False
+            self.farm.session_closed()
+
+
+class SimulatedFarm:
+    # set of simulated devices; farm.ConnectHandler is used instead of netmiko.ConnectHandler.
+    # durations are seconds, scale multiplies all of them
+
+    def __init__(self, latency=0.3, login_time=2, squeeze_time=300, copy_time=240, md5_time=120, scale=1.0,
+                 login_fail=0.0, auth_fail=0.0, refused=0.0, md5_fail=0.0, copy_stall=0.0, non_cisco_sfp=0.02,
+                 seed=1):
+        self.latency = latency
+        self.login_time = login_time
+        self.squeeze_time = squeeze_time
+        self.copy_time = copy_time
+        self.md5_time = md5_time
+        self.scale = scale
+        self.login_fail = login_fail
+        self.auth_fail = auth_fail
+        self.refused = refused
+        self.md5_fail = md5_fail
+        self.copy_stall = copy_stall
+        self.non_cisco_sfp = non_cisco_sfp
+        self.rnd = random.Random(seed)
+        self.devices = {}  # ip: SimulatedASR901
+        self.lock = Lock()
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.logins = 0
+
+    def sleep(self, seconds):
+        if seconds and self.scale:
+            time.sleep(seconds * self.scale)
+
+    def generate(self, number):
+        # returns inventory like devices.yaml: hostname: ip
+        inventory = {}
+        for i in range(number):
+            hostname = f"{self.rnd.choice(('alma', 'asta', 'shym'))}-{100000 + i:06d}-csg-1"
+            ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            self.devices[ip] = SimulatedASR901(self, hostname, ip, random.Random(f"{self.rnd.random()}"))
+            inventory[hostname] = ip
+        return inventory
+
+    def ConnectHandler(self, device_type=None, ip=None, username=None, password=None, **kwargs):
+        self.sleep(self.login_time)
+        with self.lock:
+            self.logins += 1
+            chance = self.rnd.random()
+        # same exceptions as netmiko: refused connection is a timeout exception caused by the socket error
+        if ip not in self.devices:
+            raise NetmikoTimeoutException(f"TCP connection to device failed. Device: {ip}:22")
+        if chance < self.refused:
+            raise NetmikoTimeoutException(f"TCP connection to device failed. Device: {ip}:22") \
+                from ConnectionRefusedError(f"[Errno 111] Connection refused: {ip}:22")
+        if chance < self.refused + self.auth_fail:
+            raise NetmikoAuthenticationException(f"Authentication to device failed. Device: {ip}:22")
+        if chance < self.refused + self.auth_fail + self.login_fail:
+            raise NetmikoTimeoutException(f"TCP connection to device failed. Device: {ip}:22")
+        with self.lock:
+            self.sessions += 1
+            self.peak_sessions = max(self.peak_sessions, self.sessions)
+        return SimulatedSession(self, self.devices[ip])
+
+    def session_closed(self):
+        with self.lock:
+            self.sessions -= 1
@@ -0,0 +1,333 @@
+import asyncio
+import gzip
+import json
+import re
+from pathlib import Path
+from threading import Thread
+
+from netmiko.exceptions import NetmikoAuthenticationException, NetmikoTimeoutException
+
+try:
+    import asyncssh  # only for the async engine
+except ImportError:
+    asyncssh = None
+
+
+#######################################################################################
+# ------------------------------ record / replay -------------------------------------#
+#######################################################################################
+
+# corpus: one gzip json file per device, <hostname>_<ip>.json.gz
+# {"hostname": .., "ip": .., "base_prompt": .., "batch": bool, "commands": [[command, output], ...]}
+# batch (write_channel + read_until_pattern) is saved as one command: all lines of the batch,
+# streamed copy output is saved as "read_channel" commands.
+# every session of the device (discovery, phase two, daemon jobs) is appended to its file,
+# batch is the discovery mode of the first session with discovery (None - no discovery recorded)
+
+
+def corpus_file(corpus, hostname, ip):
+    return Path(corpus) / f"{hostname}_{ip}.json.gz"
+
+
+class RecordingConnection:
+    # wraps netmiko connection and saves every command and output to the corpus on disconnect
+
+    def __init__(self, connection, corpus, hostname, ip):
+        self.connection = connection
+        self.corpus = corpus
+        self.hostname = hostname
+        self.ip = ip
+        self.commands = []
+        self.batch = None  # discovery mode of this session, see record_discovery
+        self.channel = ""
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def record_discovery(self, batch):
+        self.batch = batch
+
+    def send_command(self, command_string, *args, **kwargs):
+        output = self.connection.send_command(command_string, *args, **kwargs)
+        self.commands.append([command_string, output])
+        return output
+
+    def send_config_set(self, config_commands, *args, **kwargs):
+        output = self.connection.send_config_set(config_commands, *args, **kwargs)
+        self.commands.append(["\n".join(config_commands), output])
+        return output
+
+    def save_config(self, *args, **kwargs):
+        output = self.connection.save_config(*args, **kwargs)
+        self.commands.append(["save_config", output])
+        return output
+
+    def write_channel(self, out_data):
+        self.channel = out_data
+        return self.connection.write_channel(out_data)
+
+    def read_until_pattern(self, *args, **kwargs):
+        output = self.connection.read_until_pattern(*args, **kwargs)
+        self.commands.append([self.channel, output])
+        return output
+
+    def read_channel(self):
+        output = self.connection.read_channel()
+        if output:
+            self.commands.append(["read_channel", output])
+        return output
+
+    def save(self):
+        Path(self.corpus).mkdir(parents=True, exist_ok=True)
+        path = corpus_file(self.corpus, self.hostname, self.ip)
+        record = {"hostname": self.hostname,
+                  "ip": self.ip,
+                  "base_prompt": self.connection.base_prompt,
+                  "batch": None,
+                  "commands": []}
+        if path.is_file():
+            with gzip.open(path, "rt") as file:
+                record = json.load(file)
+        if record["batch"] is None:
+            record["batch"] = self.batch
+        record["commands"] += self.commands
+        with gzip.open(path, "wt") as file:
+            json.dump(record, file)
+        # session of daemon pool is saved after every job
+        self.commands = []
+        self.batch = None
+
+    def disconnect(self):
+        self.save()
+        return self.connection.disconnect()
+
+
+class ReplayConnection:
+    # answers commands from the corpus, in recorded order if the same command was sent several times
+
+    def __init__(self, record):
+        self.hostname = record["hostname"]
+        self.base_prompt = record["base_prompt"]
+        self.batch = record["batch"]
+        self.outputs = {}
+        for command, output in record["commands"]:
+            self.outputs.setdefault(command, []).append(output)
+        self.channel = ""
+
+    def answer(self, command):
+        outputs = self.outputs.get(command)
+        if not outputs:
+            raise KeyError(f"{self.hostname}: command is not recorded: {command!r}")
+        return outputs.pop(0) if len(outputs) > 1 else outputs[0]
+
+    def send_command(self, command_string, *args, **kwargs):
+        return self.answer(command_string)
+
+    def send_config_set(self, config_commands, *args, **kwargs):
+        return self.answer("\n".join(config_commands))
+
+    def save_config(self, *args, **kwargs):
+        return self.answer("save_config")
+
+    def write_channel(self, out_data):
+        self.channel = out_data
+
+    def read_until_pattern(self, *args, **kwargs):
+        return self.answer(self.channel)
+
+    def read_channel(self):
+        if "read_channel" not in self.outputs:
+            return ""
+        return self.answer("read_channel")
+
+    def is_alive(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+
+def load_corpus(corpus):
+    # yields device records of the corpus
+    for path in sorted(Path(corpus).glob("*.json.gz")):
+        with gzip.open(path, "rt") as file:
+            yield json.load(file)
+
+
+class ReplayHandler:
+    # replay.ConnectHandler is used instead of netmiko.ConnectHandler
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.files = {path.name.rsplit("_", 1)[1][:-len(".json.gz")]: path
+                      for path in Path(corpus).glob("*.json.gz")}
+
+    def ConnectHandler(self, device_type=None, ip=None, username=None, password=None, **kwargs):
+        if ip not in self.files:
+            raise TimeoutError(f"device is not recorded in corpus {self.corpus}: {ip}")
+        with gzip.open(self.files[ip], "rt") as file:
+            return ReplayConnection(json.load(file))
+
+
+#######################################################################################
+# ------------------------------ asyncssh transport ----------------------------------#
+#######################################################################################
+
+# async engine: ssh sessions of the run are held by one asyncio event loop (asyncssh) instead of a
+# paramiko transport thread per session. pipeline steps use AsyncConnection as netmiko connection:
+# every call is a coroutine on the loop, the pipeline thread waits for its result
+
+LEGACY_KEX = "+diffie-hellman-group14-sha1,diffie-hellman-group1-sha1"  # ssh of old IOS releases
+LEGACY_CIPHERS = "+aes128-cbc,aes256-cbc"
+LEGACY_HOST_KEYS = "+ssh-rsa"
+
+
+class AsyncTransport:
+    # transport.ConnectHandler is used instead of netmiko.ConnectHandler
+
+    def __init__(self, login_timeout=20):
+        if asyncssh is None:
+            raise ImportError("async engine needs asyncssh: pip install asyncssh")
+        self.login_timeout = login_timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def ConnectHandler(self, device_type=None, ip=None, host=None, username=None, password=None, port=22, **kwargs):
+        connection = AsyncConnection(self)
+        self.call(connection.open(ip or host, port, username, password))
+        return connection
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class AsyncConnection:
+    # interactive shell of one device. output is read all the time into the buffer,
+    # commands wait until the prompt (or expect_string) is in the buffer
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.conn = None
+        self.process = None
+        self.reader = None
+        self.buffer = ""
+        self.data = None  # asyncio.Event, set when output comes
+        self.closed = False
+        self.base_prompt = ""
+
+    async def open(self, ip, port, username, password):
+        try:
+            self.conn = await asyncio.wait_for(
+                asyncssh.connect(ip, port, username=username, password=password, known_hosts=None, client_keys=None,
+                                 agent_path=None, kex_algs=LEGACY_KEX, encryption_algs=LEGACY_CIPHERS,
+                                 server_host_key_algs=LEGACY_HOST_KEYS),
+                self.transport.login_timeout)
+        except asyncssh.PermissionDenied as err_msg:
+            raise NetmikoAuthenticationException(f"Authentication to device failed. Device: {ip}:{port}") from err_msg
+        except (OSError, asyncio.TimeoutError, asyncssh.Error) as err_msg:
+            # refused connection stays in __cause__, see classify_error
+            raise NetmikoTimeoutException(f"TCP connection to device failed. Device: {ip}:{port}") from err_msg
+        self.process = await self.conn.create_process(term_type="vt100", term_size=(511, 24),
+                                                      encoding="utf-8", errors="replace")
+        self.data = asyncio.Event()
+        self.reader = asyncio.create_task(self.read())
+        output = await self.read_until(r"[>#][ \t]*$", self.transport.login_timeout)
+        self.base_prompt = output.strip().splitlines()[-1].strip().rstrip("#>")
+        for command in ("terminal length 0", "terminal width 511"):
+            await self.command(command, None, 20)
+
+    async def read(self):
+        try:
+            while True:
+                output = await self.process.stdout.read(65536)
+                if not output:
+                    break
+                self.buffer += output.replace("\r", "")
+                self.data.set()
+        except (OSError, asyncssh.Error):
+            pass
+        self.closed = True
+        self.data.set()
+
+    async def read_until(self, pattern, read_timeout):
+        # output up to the end of the first match, the rest stays in the buffer
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + read_timeout
+        while True:
+            match = re.search(pattern, self.buffer)
+            if match:
+                output, self.buffer = self.buffer[:match.end()], self.buffer[match.end():]
+                return output
+            if self.closed:
+                raise OSError(f"{self.base_prompt}: session is closed, pattern not detected: {pattern!r}")
+            left = deadline - loop.time()
+            if left <= 0:
+                raise NetmikoTimeoutException(f"{self.base_prompt}: pattern not detected: {pattern!r}")
+            self.data.clear()
+            try:
+                await asyncio.wait_for(self.data.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+
+    def prompt(self):
+        # exec or config mode prompt at the start of a line: host#, host(config)#
+        return rf"(?m)^{re.escape(self.base_prompt)}[^\n]*[>#][ \t]*$"
+
+    async def command(self, command_string, expect_string, read_timeout, strip_command=True, strip_prompt=True):
+        self.process.stdin.write(command_string + "\n")
+        lines = (await self.read_until(expect_string or self.prompt(), read_timeout)).split("\n")
+        if strip_command:
+            lines = lines[1:]  # echo of the command
+        if strip_prompt and lines and lines[-1].startswith(self.base_prompt):
+            lines = lines[:-1]
+        return "\n".join(lines)
+
+    async def config(self, config_commands, read_timeout):
+        output = []
+        for line in ["configure terminal"] + list(config_commands) + ["end"]:
+            output.append(await self.command(line, None, read_timeout, strip_command=False, strip_prompt=False))
+        return "\n".join(output)
+
+    async def write(self, out_data):
+        self.process.stdin.write(out_data)
+
+    async def take(self):
+        output, self.buffer = self.buffer, ""
+        return output
+
+    async def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            await self.conn.wait_closed()
+
+    def send_command(self, command_string, expect_string=None, read_timeout=10, strip_command=True,
+                     strip_prompt=True, **kwargs):
+        return self.transport.call(self.command(command_string, expect_string, read_timeout,
+                                                strip_command, strip_prompt))
+
+    def send_config_set(self, config_commands, read_timeout=10, **kwargs):
+        return self.transport.call(self.config(config_commands, read_timeout))
+
+    def save_config(self, *args, **kwargs):
+        return self.transport.call(self.command("write memory", None, 60, strip_command=False, strip_prompt=False))
+
+    def write_channel(self, out_data):
+        self.transport.call(self.write(out_data))
+
+    def read_channel(self):
+        return self.transport.call(self.take())
+
+    def read_until_pattern(self, pattern="", read_timeout=10, **kwargs):
+        return self.transport.call(self.read_until(pattern, read_timeout))
+
+    def is_alive(self):
+        return self.conn is not None and not self.closed
+
+    def disconnect(self):
+        self.transport.call(self.close())